@@ -2,14 +2,21 @@
 import os
 import getpass
 
+from typing import Dict
+
 from fastapi import FastAPI, Request
+from fastapi.responses import FileResponse, StreamingResponse
 from fastapi.templating import Jinja2Templates 
 
 from torch.cuda import empty_cache
 import uvicorn
 
 from src.backend.llm_call import LLMCall
+from src.backend.llm_dialog import DialogEvent, LlamaDialog
+from src.backend.llm_governor import GenerationGovernor
 from src.backend.llm import ModelClass
+from src.backend.llm_profiler import LLMProfiler
+from src.backend.llm_semantic_cache import SemanticCache
 from src.frontend.gradio_chat_interface import create_chat_interface
 
 import gradio as gr
@@ -42,10 +49,18 @@ Usage:
 Endpoints:
 - POST "/ask": Ask a question to the LLM. Provide the question in the request body. Returns the LLM response and the UUID of the dialog.
 - GET "/ask": Provides a message instructing to use POST for asking questions.
+- POST "/ask_stream": Same as POST "/ask", but streams the LLM response as plain text. The UUID of the dialog is returned in the "X-Dialog-UUID" header.
 - GET "/clear_history": Clears the conversation history and frees up memory. Returns a message indicating the history is cleared and the number of dialogs removed.
 - GET "/delete_dialog": Deletes a specific dialog using its UUID.
 - GET "/show_dialog": Shows the content of a specific dialog. Provide the UUID of the dialog in the request parameters.
 - GET "/show_history": Shows the conversation history (dialogs).
+- GET "/list_dialogs": Lists the UUIDs of the dialogs held by this instance that can be moved to another instance (the Gradio chat dialogs are not listed).
+- GET "/export_dialog": Exports a specific dialog, so it can be moved to another instance.
+- POST "/import_dialog": Imports a dialog exported from another instance.
+- GET "/governor_status": Shows the server load and the adjustments of the generation parameters made under high load.
+- GET "/profiling": Shows or updates the profiling settings (fraction of the requests to profile, profiling of debug requests).
+- GET "/list_traces": Lists the profiling traces captured so far.
+- GET "/get_trace": Downloads a profiling trace (Chrome-trace format).
 - GET "/": Root endpoint showing the model name of the LLM (ModelClass).
 
 Required Libraries:
@@ -79,6 +94,34 @@ app = FastAPI()
 dialogs = []
 # Loading up the ModelClass instance
 llm = ModelClass()
+# Profiler capturing traces for debug requests or a sampled fraction of the requests
+profiler = LLMProfiler(trace_dir=os.environ.get('LLMP_TRACE_DIR', 'traces'))
+# Optional cache answering paraphrases of previous first-turn questions, using embeddings from the encoder of the model
+semantic_cache = SemanticCache(llm.embed,
+                               similarity_threshold=float(os.environ.get('LLMP_SEMANTIC_CACHE_THRESHOLD', 0.95)),
+                               max_size=int(os.environ.get('LLMP_SEMANTIC_CACHE_SIZE', 1000))
+                               ) if os.environ.get('LLMP_SEMANTIC_CACHE') else None
+# Governor capping the generation parameters under high load, the policy can be provided as a json file
+# The parameters not sent by the clients are compared to the defaults of the model, so that they are only reported as capped when actually lowered
+governor_defaults = llm.generation_config.to_dict()
+governor = (GenerationGovernor.from_json(os.environ['LLMP_GOVERNOR_POLICY'], defaults=governor_defaults) if os.environ.get('LLMP_GOVERNOR_POLICY')
+            else GenerationGovernor(defaults=governor_defaults))
+
+
+class GovernedStreamingResponse(StreamingResponse):
+    """
+    Streaming response counting its request as in flight until it is over, whether it was fully sent, interrupted or never started
+    (e.g. the client disconnected before the streaming started).
+    """
+    def __init__(self, *args, generation_record: Dict, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.generation_record = generation_record
+
+    async def __call__(self, scope, receive, send) -> None:
+        try:
+            await super().__call__(scope, receive, send)
+        finally:
+            governor.finish(self.generation_record)
     
 
 templates = Jinja2Templates(directory="src/frontend/templates")
@@ -94,9 +137,10 @@ async def read_root(request: Request):
     return templates.TemplateResponse("home.html", {"request":request, "name":"Loic Muhirwa"})
 
 @app.post("/ask")
-async def read_question(llm_call: LLMCall) -> dict:
+def read_question(llm_call: LLMCall) -> dict:
     """
     Endpoint to receive a question and get the LLM response.
+    Not async: the generation is blocking, so FastAPI runs the endpoint in its threadpool and concurrent requests do not wait on the event loop.
 
     Parameters:
         llm_call (LLMCall): The request containing the question and other parameters.
@@ -105,10 +149,31 @@ async def read_question(llm_call: LLMCall) -> dict:
         dict: A dictionary containing the LLM response (message) and the UUID of the dialog.
     """
     global dialogs
-    llm_response, uuid, warning_messages, debug_info = llm_call.ask_llm(llm=llm, dialogs=dialogs) 
+    llm_response, uuid, warning_messages, debug_info = llm_call.ask_llm(llm=llm, dialogs=dialogs, profiler=profiler, semantic_cache=semantic_cache, governor=governor)
    
     return {"message": llm_response, 'uuid': uuid, 'warnings': warning_messages, 'debug_info': debug_info}
 
+@app.post("/ask_stream")
+async def read_question_stream(llm_call: LLMCall) -> StreamingResponse:
+    """
+    Endpoint to receive a question and stream the LLM response.
+
+    Parameters:
+        llm_call (LLMCall): The request containing the question and other parameters.
+
+    Returns:
+        StreamingResponse: The LLM response streamed as plain text, the UUID of the dialog is in the "X-Dialog-UUID" header and the warnings in the "X-Warnings" header.
+    """
+    global dialogs
+    generation_record = governor.start() # Counting the request as in flight as soon as it arrives
+    try:
+        generator, uuid, warning_messages = llm_call.ask_llm_stream(llm=llm, dialogs=dialogs, governor=governor, generation_record=generation_record)
+    except BaseException:
+        governor.finish(generation_record)
+        raise
+    return GovernedStreamingResponse(generator, generation_record=generation_record, media_type='text/plain',
+                                     headers={'X-Dialog-UUID': uuid, 'X-Warnings': ' /n'.join(warning_messages)})
+
 @app.get("/ask")
 async def get_ask() -> str:
     """
@@ -187,11 +252,115 @@ async def show_history() -> dict:
     global dialogs
     return {'history': dialogs}
 
+@app.get("/list_dialogs")
+async def list_dialogs() -> dict:
+    """
+    Endpoint to list the UUIDs of the dialogs held by this instance that can be moved to another instance.
+    The dialogs pinned to this instance (Gradio chat dialogs) are not listed.
+
+    Returns:
+        dict: A dictionary containing the UUIDs of the dialogs, without duplicates.
+    """
+    global dialogs
+    return {'uuids': list(dict.fromkeys(ditem.UUID for ditem in dialogs if not ditem.pinned))}
+
+@app.get("/export_dialog")
+async def export_dialog(uuid: str) -> dict:
+    """
+    Endpoint to export a specific dialog, so it can be imported by another instance.
+
+    Parameters:
+        uuid (str): The UUID of the dialog to export.
+
+    Returns:
+        dict: The dialog.
+    """
+    global dialogs
+    dialog = [ditem for ditem in dialogs if ditem.UUID == uuid]
+    if not dialog:
+        raise(Exception("Dialog not found"))
+    return dialog[0].model_dump()
+
+@app.post("/import_dialog")
+async def import_dialog(dialog_data: dict) -> str:
+    """
+    Endpoint to import a dialog exported from another instance. Replaces the dialog with the same UUID if there is one.
+
+    Parameters:
+        dialog_data (dict): The dialog, as returned by "/export_dialog".
+
+    Returns:
+        str: Contains a string with the outcome.
+    """
+    global dialogs
+    dialog = LlamaDialog(UUID=dialog_data['UUID'],
+                         no_history=dialog_data['no_history'],
+                         system_prompt=dialog_data['system_prompt'],
+                         creation_datetime=dialog_data['creation_datetime'])
+    dialog.dialog = [DialogEvent(**{key: value for key, value in event.items() if key != 'content_len'}) for event in dialog_data['dialog']]
+    dialogs_without_uuid = [ditem for ditem in dialogs if ditem.UUID != dialog.UUID]
+    dialogs.clear()
+    dialogs.extend(dialogs_without_uuid + [dialog])
+    return f"Dialog {dialog.UUID} imported!"
+
+@app.get("/governor_status")
+async def governor_status() -> dict:
+    """
+    Endpoint to show the server load and the adjustments of the generation parameters.
+
+    Returns:
+        dict: The queue depth, recent tokens/s, current degradation level, number of adjusted generations per level and the policy.
+    """
+    return governor.status()
+
+@app.get("/profiling")
+async def profiling(sample_rate: float = None, profile_debug: bool = None) -> dict:
+    """
+    Endpoint to show or update the profiling settings.
+
+    Parameters:
+        sample_rate (float): Fraction of the requests to profile, in [0, 1]. 0 disables the sampled profiling.
+        profile_debug (bool): If True, every request with the debug flag is profiled.
+
+    Returns:
+        dict: The current profiling settings.
+    """
+    if sample_rate is not None:
+        if not 0 <= sample_rate <= 1:
+            raise(ValueError('sample_rate must be between 0 and 1'))
+        profiler.sample_rate = sample_rate
+    if profile_debug is not None:
+        profiler.profile_debug = profile_debug
+    return {'sample_rate': profiler.sample_rate, 'profile_debug': profiler.profile_debug, 'trace_dir': profiler.trace_dir}
+
+@app.get("/list_traces")
+async def list_traces() -> dict:
+    """
+    Endpoint to list the profiling traces.
+
+    Returns:
+        dict: A dictionary containing the traces, most recent first.
+    """
+    return {'traces': profiler.list_traces()}
+
+@app.get("/get_trace")
+async def get_trace(name: str) -> FileResponse:
+    """
+    Endpoint to download a profiling trace.
+
+    Parameters:
+        name (str): The name of the trace file, as returned by "/list_traces".
+
+    Returns:
+        FileResponse: The trace in Chrome-trace format (open in chrome://tracing or https://ui.perfetto.dev).
+    """
+    return FileResponse(profiler.get_trace_path(name), media_type='application/json', filename=name)
+
 
 
 
 #Gradio app for providing an interactive chat interface
-interface = create_chat_interface(delete_dialog, llm, dialogs)
+interface = create_chat_interface(delete_dialog, llm, dialogs, governor=governor)
 interface.queue(concurrency_count=40)
 CHAT_PATH = '/chat'
 app = gr.mount_gradio_app(app, interface, path=CHAT_PATH)
@@ -203,7 +372,7 @@ if __name__ == "__main__":
     print("Starting the API Server ...")
     uvicorn.run(app,
                 host="0.0.0.0",
-                port=6969
+                port=int(os.environ.get('LLMP_PORT', 6969))
                 )
 
               
\ No newline at end of file
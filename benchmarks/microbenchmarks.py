@@ -0,0 +1,203 @@
+import argparse
+import json
+import os
+import sys
+import timeit
+
+from functools import lru_cache
+from typing import Callable, Dict, List, Tuple
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from transformers import AutoTokenizer, GenerationConfig
+
+from src.backend.llm import ModelClass
+from src.backend.llm_call import LLMCall
+from src.backend.llm_dialog import DialogEvent, LlamaDialog
+
+
+"""
+Microbenchmarks of the CPU-bound Python components of the application, to catch performance regressions.
+
+The benchmarks run on synthetic dialogs from 1 to 10k turns:
+- LlamaDialog.get_llm_formated_dialog and LlamaDialog.dialog_len
+- DialogEvent construction
+- UUID lookup of a dialog (LLMCall.__get_dialog)
+- GenerationConfig cloning (ModelClass.clone_generation_config), as done for every request in ModelClass.ask_llm
+- tokenizer round trips (encoding and decoding of a formatted dialog)
+
+The tokenizer and the GenerationConfig are only loaded when their benchmarks are selected, e.g. `--filter dialog_len` runs offline.
+
+Usage:
+    python benchmarks/microbenchmarks.py run                      # Runs the benchmarks and prints the results
+    python benchmarks/microbenchmarks.py save                     # Runs the benchmarks and stores the results as the baseline
+    python benchmarks/microbenchmarks.py compare --threshold 0.2  # Runs the benchmarks and fails if one is more than 20% slower than the baseline, or missing
+
+The baseline is stored in benchmarks/baseline.json, it should be saved on the machine running the comparisons.
+
+"""
+
+
+BASELINE_PATH: str = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'baseline.json')
+DIALOG_TURNS: List[int] = [1, 10, 100, 1000, 10000]
+TOKENIZER_TURNS: List[int] = [1, 10, 100]
+
+
+def make_dialog(turns: int) -> LlamaDialog:
+    """
+    Creates a synthetic dialog ending with a user question.
+
+    Parameters:
+        turns (int): Number of user questions in the dialog.
+
+    Returns:
+        LlamaDialog: The dialog.
+    """
+    dialog = LlamaDialog()
+    for turn in range(turns - 1):
+        dialog.user_ask(f"Question {turn}: what is the largest country in the world, and what is its population?")
+        dialog.assistant_reply(f"Answer {turn}: Russia is the largest country in the world, with a population of about 144 million people.")
+    dialog.user_ask("What is the smallest country in the world?")
+    return dialog
+
+
+@lru_cache(maxsize=None)
+def load_tokenizer() -> AutoTokenizer:
+    return AutoTokenizer.from_pretrained(ModelClass.MODEL_PATH)
+
+
+@lru_cache(maxsize=None)
+def load_generation_config() -> GenerationConfig:
+    # Same default config as ModelClass
+    generation_config = GenerationConfig.from_pretrained(ModelClass.MODEL_PATH)
+    generation_config.update(do_sample=True, max_length=1000)
+    return generation_config
+
+
+def setup_dialog_lookup(turns: int) -> Callable:
+    dialogs = [LlamaDialog() for _ in range(turns)]
+    llm_call = LLMCall(question='What is the smallest country in the world?', uuid=dialogs[-1].UUID)
+    return lambda: llm_call._LLMCall__get_dialog(dialogs)
+
+
+def setup_generation_config_clone() -> Callable:
+    generation_config = load_generation_config()
+    return lambda: ModelClass.clone_generation_config(generation_config, eos_token_id=[generation_config.eos_token_id],
+                                                      temperature=0.5, top_p=0.95, top_k=100, max_new_tokens=128)
+
+
+def setup_tokenizer_round_trip(turns: int) -> Callable:
+    tokenizer, formated_dialog = load_tokenizer(), make_dialog(turns).get_llm_formated_dialog()
+    return lambda: tokenizer.batch_decode(tokenizer(formated_dialog, return_tensors='pt')['input_ids'], skip_special_tokens=True)
+
+
+def get_benchmarks() -> List[Tuple[str, Callable[[], Callable]]]:
+    """
+    Lists the benchmarks. Each benchmark comes with a setup function, only called when the benchmark is selected,
+    so that the tokenizer and the generation config are not loaded when their benchmarks are not run.
+
+    Returns:
+        List[Tuple[str, Callable[[], Callable]]]: Name of each benchmark and setup function returning the function to benchmark.
+    """
+    benchmarks = []
+    for turns in DIALOG_TURNS:
+        benchmarks.append((f'get_llm_formated_dialog[{turns}]', lambda turns=turns: make_dialog(turns).get_llm_formated_dialog))
+        benchmarks.append((f'dialog_len[{turns}]', lambda turns=turns: lambda dialog=make_dialog(turns): dialog.dialog_len))
+        benchmarks.append((f'get_dialog_by_uuid[{turns}]', lambda turns=turns: setup_dialog_lookup(turns)))
+
+    benchmarks.append(('dialog_event', lambda: lambda: DialogEvent(role='user', llama_dialog_uuid='dialog', content='What is the smallest country in the world?')))
+    benchmarks.append(('generation_config_clone', setup_generation_config_clone))
+    for turns in TOKENIZER_TURNS:
+        benchmarks.append((f'tokenizer_round_trip[{turns}]', lambda turns=turns: setup_tokenizer_round_trip(turns)))
+    return benchmarks
+
+
+def is_selected(name: str, name_filter: str = None) -> bool:
+    return not name_filter or name_filter in name
+
+
+def run_benchmarks(name_filter: str = None, repeat: int = 5) -> Dict[str, float]:
+    """
+    Runs the benchmarks.
+
+    Parameters:
+        name_filter (str): If provided, only the benchmarks whose name contains it are run.
+        repeat (int): Number of measures of each benchmark, the fastest one is kept.
+
+    Returns:
+        Dict[str, float]: Time per call of each benchmark, in seconds.
+    """
+    results = {}
+    for name, setup in get_benchmarks():
+        if not is_selected(name, name_filter):
+            continue
+        timer = timeit.Timer(setup())
+        number, _ = timer.autorange()
+        results[name] = min(timer.repeat(repeat=repeat, number=number)) / number
+        print(f"{name:<40} {results[name] * 1e6:>14.2f} us")
+    return results
+
+
+def compare(results: Dict[str, float], baseline: Dict[str, float], threshold: float, name_filter: str = None) -> List[str]:
+    """
+    Compares the results with the baseline.
+
+    Parameters:
+        results (Dict[str, float]): Time per call of each benchmark.
+        baseline (Dict[str, float]): Time per call of each benchmark in the baseline.
+        threshold (float): Maximum allowed slowdown, e.g. 0.2 for 20%.
+        name_filter (str): If provided, only the baseline benchmarks whose name contains it are expected in the results.
+
+    Returns:
+        List[str]: The names of the benchmarks slower than the baseline by more than the threshold, or missing from the results.
+    """
+    regressions = []
+    print(f"\n{'benchmark':<40} {'baseline (us)':>14} {'current (us)':>14} {'change':>8}")
+    for name, duration in results.items():
+        if name not in baseline:
+            print(f"{name:<40} {'-':>14} {duration * 1e6:>14.2f} {'new':>8}")
+            continue
+        change = duration / baseline[name] - 1
+        regression = change > threshold
+        if regression:
+            regressions.append(name)
+        print(f"{name:<40} {baseline[name] * 1e6:>14.2f} {duration * 1e6:>14.2f} {change:>+8.1%}" + ('  REGRESSION' if regression else ''))
+    # A benchmark removed or renamed would otherwise silently pass
+    for name in baseline:
+        if name not in results and is_selected(name, name_filter):
+            regressions.append(name)
+            print(f"{name:<40} {baseline[name] * 1e6:>14.2f} {'-':>14} {'missing':>8}  REGRESSION")
+    return regressions
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description='Microbenchmarks of the CPU-bound components')
+    parser.add_argument('command', choices=['run', 'save', 'compare'])
+    parser.add_argument('--baseline', default=BASELINE_PATH, help='Path to the baseline results')
+    parser.add_argument('--threshold', type=float, default=0.2, help='Maximum allowed slowdown compared to the baseline (0.2 = 20%%)')
+    parser.add_argument('--filter', default=None, help='Only runs the benchmarks whose name contains this string')
+    parser.add_argument('--repeat', type=int, default=5, help='Number of measures of each benchmark, the fastest one is kept')
+    args = parser.parse_args()
+
+    results = run_benchmarks(name_filter=args.filter, repeat=args.repeat)
+
+    if args.command == 'save':
+        with open(args.baseline, 'w') as baseline_file:
+            json.dump(results, baseline_file, indent=4)
+        print(f"\nBaseline saved to {args.baseline}")
+    elif args.command == 'compare':
+        if not os.path.isfile(args.baseline):
+            print(f"\nBaseline {args.baseline} not found, create it with the save command")
+            return 1
+        with open(args.baseline) as baseline_file:
+            baseline = json.load(baseline_file)
+        regressions = compare(results, baseline, args.threshold, name_filter=args.filter)
+        if regressions:
+            print(f"\n{len(regressions)} benchmark(s) slower than the baseline by more than {args.threshold:.0%} or missing: {', '.join(regressions)}")
+            return 1
+        print(f"\nNo regression above {args.threshold:.0%}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
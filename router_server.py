@@ -0,0 +1,360 @@
+import os
+import asyncio
+
+from typing import Awaitable, Callable
+
+from fastapi import FastAPI, Request, Response
+from fastapi.responses import StreamingResponse
+import httpx
+import uvicorn
+
+from src.backend.llm_dialog import uuid_factory
+from src.router.hash_ring import ConsistentHashRing
+
+
+"""
+SAA-Tech LLM - Router
+
+Dialogs live in the memory of the API server instance that created them. This script provides a lightweight router that spreads the dialogs
+over several instances of api_server.py, and sends every request about a dialog to the instance holding it.
+
+The dialog UUIDs are consistent-hashed onto the instances. New dialogs get their UUID from the router, so their first request already
+lands on the right instance. When an instance joins or leaves, only the dialogs whose owner changed are moved between instances.
+
+Usage:
+1. Start the API server instances (the port of an instance can be set with the LLMP_PORT environment variable).
+2. Start the router by running this script, with the instance urls in the LLMP_BACKENDS environment variable (comma separated).
+   The LLMP_MIGRATION_TIMEOUT environment variable sets how long the requests in flight are waited for when rebalancing (default: 60 s).
+
+Endpoints:
+- POST "/ask": Forwarded to the instance owning the dialog.
+- POST "/ask_stream": Forwarded to the instance owning the dialog, the response is streamed back.
+- GET "/delete_dialog": Forwarded to the instance owning the dialog.
+- GET "/show_dialog": Forwarded to the instance owning the dialog.
+- GET "/show_history": Gathers the dialogs of all the instances.
+- GET "/clear_history": Clears the dialogs of all the instances.
+- GET "/list_instances": Lists the instances.
+- GET "/add_instance": Adds an instance and moves to it the dialogs it now owns.
+- GET "/remove_instance": Moves the dialogs of an instance to the remaining ones and removes it.
+
+Note:
+- The Gradio chat interface ("/chat") is not routed, it keeps its dialogs on the instance serving it. These dialogs are pinned to their instance
+  and never moved when rebalancing.
+
+"""
+
+print("Setting up the router...")
+app = FastAPI()
+backends = [url.strip().rstrip('/') for url in os.environ.get('LLMP_BACKENDS', 'http://localhost:6969').split(',') if url.strip()]
+ring = ConsistentHashRing(backends)
+client = httpx.AsyncClient(timeout=httpx.Timeout(None, connect=10.))
+# New requests are held while dialogs are moved, otherwise a request could reach a dialog in the middle of its migration
+rebalance_lock = asyncio.Lock()
+not_rebalancing = asyncio.Event()
+not_rebalancing.set()
+# Number of forwarded requests not finished yet for each dialog uuid, a dialog is only moved once its requests are over
+in_flight = {}
+in_flight_changed = asyncio.Condition()
+# Dialogs that could not be moved while rebalancing stay on their instance, uuid -> url of the instance holding the dialog
+dialog_routes = {}
+# Maximum time waited for the requests in flight to be over before moving dialogs, in seconds
+migration_timeout = float(os.environ.get('LLMP_MIGRATION_TIMEOUT', 60.))
+
+
+class ForwardedStreamingResponse(StreamingResponse):
+    """
+    Streaming response running a callback once it is over, whether it was fully sent, interrupted or never started
+    (e.g. the client disconnected before the streaming started).
+    """
+    def __init__(self, *args, on_close: Callable[[], Awaitable[None]], **kwargs):
+        super().__init__(*args, **kwargs)
+        self.on_close = on_close
+
+    async def __call__(self, scope, receive, send) -> None:
+        try:
+            await super().__call__(scope, receive, send)
+        finally:
+            await self.on_close()
+
+
+def to_response(backend_response: httpx.Response) -> Response:
+    """
+    Converts the response of an instance to a response of the router.
+    """
+    return Response(content=backend_response.content,
+                    status_code=backend_response.status_code,
+                    media_type=backend_response.headers.get('content-type'))
+
+
+async def start_request(uuid: str) -> str:
+    """
+    Waits for any rebalancing to be over, then counts a request about a dialog as in flight.
+
+    Returns:
+        str: The url of the instance owning the dialog.
+    """
+    await not_rebalancing.wait()
+    # No await between the check above and the count below, so a rebalancing cannot start in between
+    in_flight[uuid] = in_flight.get(uuid, 0) + 1
+    return dialog_routes.get(uuid) or ring.get_node(uuid)
+
+
+async def end_request(uuid: str) -> None:
+    """
+    Counts a request about a dialog as finished.
+    """
+    async with in_flight_changed:
+        in_flight[uuid] -= 1
+        if not in_flight[uuid]:
+            del in_flight[uuid]
+        in_flight_changed.notify_all()
+
+
+async def forward_get(path: str, uuid: str) -> Response:
+    """
+    Forwards a GET request about a dialog to the instance owning it.
+    """
+    backend = await start_request(uuid)
+    try:
+        backend_response = await client.get(f"{backend}{path}", params={'uuid': uuid})
+    finally:
+        await end_request(uuid)
+    return to_response(backend_response)
+
+
+async def get_request_body(request: Request) -> dict:
+    """
+    Reads the body of an "/ask" request, giving a UUID to new dialogs so they can be placed on the ring.
+    """
+    body = await request.json()
+    if not body.get('uuid'):
+        body['uuid'] = uuid_factory()
+    return body
+
+
+async def wait_in_flight(predicate: Callable[[], bool]) -> None:
+    """
+    Waits for the requests in flight to satisfy a predicate, raises asyncio.TimeoutError after migration_timeout seconds.
+    """
+    async with in_flight_changed:
+        await asyncio.wait_for(in_flight_changed.wait_for(predicate), timeout=migration_timeout)
+
+
+async def migrate_dialog(uuid: str, source: str, target: str) -> None:
+    """
+    Moves a dialog from an instance to another one, once the requests about it are over.
+    """
+    await wait_in_flight(lambda: uuid not in in_flight)
+    exported = await client.get(f"{source}/export_dialog", params={'uuid': uuid})
+    exported.raise_for_status()
+    imported = await client.post(f"{target}/import_dialog", json=exported.json())
+    imported.raise_for_status()
+    deleted = await client.get(f"{source}/delete_dialog", params={'uuid': uuid})
+    deleted.raise_for_status()
+
+
+async def migrate_dialogs(moves: list) -> tuple:
+    """
+    Moves dialogs between instances. A failed migration does not stop the others, the dialog stays on its source instance
+    and its requests keep being sent there.
+
+    Parameters:
+        moves (list): (uuid, source, target) of each dialog to move.
+
+    Returns:
+        tuple: The number of dialogs moved and the list of the uuids that could not be moved.
+    """
+    moved, failed = 0, []
+    for uuid, source, target in moves:
+        try:
+            await migrate_dialog(uuid, source, target)
+            dialog_routes.pop(uuid, None)
+            moved += 1
+        except (httpx.HTTPError, asyncio.TimeoutError) as e:
+            print(f"Could not move dialog {uuid} from {source} to {target}: {e!r}")
+            failed.append(uuid)
+            if source in ring.nodes:
+                dialog_routes[uuid] = source
+            else:
+                dialog_routes.pop(uuid, None)
+    return moved, failed
+
+
+async def drain_in_flight() -> None:
+    """
+    Waits for all the requests in flight to be over, before listing the dialogs to move. Raises TimeoutError if they are not over
+    after migration_timeout seconds, so that the rebalancing is aborted before changing the ring.
+    """
+    try:
+        await wait_in_flight(lambda: not in_flight)
+    except asyncio.TimeoutError:
+        raise(TimeoutError(f'Requests still in flight after {migration_timeout} s, retry the rebalancing later'))
+
+
+async def list_dialogs(backend: str) -> list:
+    """
+    Lists the UUIDs of the dialogs held by an instance.
+    """
+    response = await client.get(f"{backend}/list_dialogs")
+    response.raise_for_status()
+    return response.json()['uuids']
+
+
+@app.post("/ask")
+async def ask(request: Request) -> Response:
+    """
+    Endpoint forwarding a question to the instance owning the dialog.
+    """
+    body = await get_request_body(request)
+    backend = await start_request(body['uuid'])
+    try:
+        backend_response = await client.post(f"{backend}/ask", json=body)
+    finally:
+        await end_request(body['uuid'])
+    return to_response(backend_response)
+
+
+@app.post("/ask_stream")
+async def ask_stream(request: Request) -> StreamingResponse:
+    """
+    Endpoint forwarding a question to the instance owning the dialog, and streaming back the response.
+    """
+    body = await get_request_body(request)
+    backend = await start_request(body['uuid'])
+    try:
+        backend_request = client.build_request('POST', f"{backend}/ask_stream", json=body)
+        backend_response = await client.send(backend_request, stream=True)
+    except BaseException:
+        await end_request(body['uuid'])
+        raise
+
+    async def close() -> None:
+        await backend_response.aclose()
+        await end_request(body['uuid'])
+
+    # The request is in flight until the whole response is streamed, the dialog is only updated at the end of the stream
+    return ForwardedStreamingResponse(backend_response.aiter_raw(),
+                                      on_close=close,
+                                      status_code=backend_response.status_code,
+                                      media_type=backend_response.headers.get('content-type'),
+                                      headers={'X-Dialog-UUID': backend_response.headers.get('X-Dialog-UUID', body['uuid'])})
+
+
+@app.get("/delete_dialog")
+async def delete_dialog(uuid: str) -> Response:
+    """
+    Endpoint forwarding the deletion of a dialog to the instance owning it.
+    """
+    return await forward_get("/delete_dialog", uuid)
+
+
+@app.get("/show_dialog")
+async def show_dialog(uuid: str) -> Response:
+    """
+    Endpoint forwarding the display of a dialog to the instance owning it.
+    """
+    return await forward_get("/show_dialog", uuid)
+
+
+@app.get("/show_history")
+async def show_history() -> dict:
+    """
+    Endpoint gathering the dialogs of all the instances.
+
+    Returns:
+        dict: A dictionary containing the conversation history (dialogs) of all the instances.
+    """
+    responses = await asyncio.gather(*[client.get(f"{backend}/show_history") for backend in ring.nodes])
+    return {'history': [ditem for response in responses for ditem in response.json()['history']]}
+
+
+@app.get("/clear_history")
+async def clear_history() -> dict:
+    """
+    Endpoint clearing the dialogs of all the instances.
+
+    Returns:
+        dict: A dictionary containing a message indicating that the history is cleared.
+    """
+    await asyncio.gather(*[client.get(f"{backend}/clear_history") for backend in ring.nodes])
+    return {"message": 'History cleared, all dialogs removed on all the instances', 'instances': len(ring)}
+
+
+@app.get("/list_instances")
+async def list_instances() -> dict:
+    """
+    Endpoint listing the instances.
+
+    Returns:
+        dict: A dictionary containing the urls of the instances.
+    """
+    return {'instances': ring.nodes}
+
+
+@app.get("/add_instance")
+async def add_instance(url: str) -> dict:
+    """
+    Endpoint adding an instance. The dialogs now owned by the new instance are moved to it, the other dialogs stay where they are.
+
+    Parameters:
+        url (str): The url of the instance, e.g. http://10.0.0.2:6969
+
+    Returns:
+        dict: A dictionary containing the urls of the instances, the number of dialogs moved and the uuids of the dialogs that could not be moved.
+    """
+    url = url.rstrip('/')
+    async with rebalance_lock:
+        not_rebalancing.clear()
+        try:
+            # New requests are held, waiting for the ones in flight so that the dialogs they create are listed
+            await drain_in_flight()
+            # Listing the dialogs before changing the ring, so that the ring is left untouched if an instance cannot be reached
+            dialogs_per_backend = {backend: await list_dialogs(backend) for backend in ring.nodes}
+            ring.add_node(url)
+            moved, failed = await migrate_dialogs([(uuid, backend, url)
+                                                   for backend, uuids in dialogs_per_backend.items()
+                                                   for uuid in uuids if ring.get_node(uuid) == url])
+        finally:
+            not_rebalancing.set()
+    return {'instances': ring.nodes, 'moved_dialogs': moved, 'failed_dialogs': failed}
+
+
+@app.get("/remove_instance")
+async def remove_instance(url: str) -> dict:
+    """
+    Endpoint removing an instance. Its dialogs are moved to the instances now owning them.
+
+    Parameters:
+        url (str): The url of the instance.
+
+    Returns:
+        dict: A dictionary containing the urls of the remaining instances, the number of dialogs moved and the uuids of the dialogs that could not be moved.
+    """
+    url = url.rstrip('/')
+    async with rebalance_lock:
+        if len(ring) == 1 and url in ring.nodes:
+            raise(ValueError('Cannot remove the last instance'))
+        not_rebalancing.clear()
+        try:
+            await drain_in_flight()
+            ring.remove_node(url)
+            try:
+                uuids = await list_dialogs(url)
+            except httpx.HTTPError as e:
+                # The instance is already down, its dialogs are lost
+                print(f"Could not reach {url}, its dialogs were not moved: {e}")
+                uuids = []
+                for uuid in [uuid for uuid, backend in dialog_routes.items() if backend == url]:
+                    del dialog_routes[uuid]
+            moved, failed = await migrate_dialogs([(uuid, url, ring.get_node(uuid)) for uuid in uuids])
+        finally:
+            not_rebalancing.set()
+    return {'instances': ring.nodes, 'moved_dialogs': moved, 'failed_dialogs': failed}
+
+
+if __name__ == "__main__":
+    print("Starting the router ...")
+    uvicorn.run(app,
+                host="0.0.0.0",
+                port=int(os.environ.get('LLMP_ROUTER_PORT', 6970))
+                )
@@ -1,13 +1,15 @@
 import json
+import numpy as np
+import time
 import torch
 
 from threading import Thread
-from typing import  List,  Generator
+from typing import  List,  Generator, Optional, Union
 
 import warnings
 
 from transformers import AutoTokenizer, AutoModelForSeq2SeqLM, GenerationConfig
-from transformers import StoppingCriteria, StoppingCriteriaList, TextIteratorStreamer
+from transformers import LogitsProcessor, LogitsProcessorList, StoppingCriteria, StoppingCriteriaList, TextIteratorStreamer
 
 
 """
@@ -16,13 +18,14 @@ This script provides functionalities for setting up and interacting with the Mod
 Classes:
 - ModelClass: A class responsible for loading the ModelClass-13b model using Hugging Face Transformers. 
           It includes a method to generate responses from the LLM, as well as a generator function to output streaming responses.
+          It also provides sentence embeddings computed with the encoder of the model.
+          Generations can be stopped by stop sequences, passed as 'stop_sequences' with the generation parameters.
 
 """
 
 class ModelClass:
 
     MODEL_PATH: str = "google/flan-t5-small"
-    MODEL_EOS_TOKENS_IDS: List[int] = [2]
 
     
     def __init__(self):
@@ -54,6 +57,8 @@ class ModelClass:
             self.model = AutoModelForSeq2SeqLM.from_pretrained(self.MODEL_PATH)
             self.generation_config = GenerationConfig.from_pretrained(self.MODEL_PATH)
             self.generation_config.update(do_sample = True, max_length = 1000)
+            # Text of each token decoded on its own, to find the tokens that can end a stop sequence
+            self.token_texts = self.tokenizer.batch_decode([[token_id] for token_id in range(len(self.tokenizer))], skip_special_tokens=True)
 
             
         
@@ -62,14 +67,16 @@ class ModelClass:
         else:
             print(f"Model {self.model_name} loaded successfully")
    
-    def ask_llm(self, question: str, debug:bool = False, **kwargs) -> tuple:
+    def ask_llm(self, question: str, debug:bool = False, generation_stats: dict = None, **kwargs) -> tuple:
         """
         Generates a response from the ModelClass model given a question. Not using the pipeline to provide warnings and  debug information to the user.
 
         Parameters:
             question (str): The input question.
             debug (bool): If True will provide additional debug info about the prompt 
-            **kwargs: Additional keyword arguments.
+            generation_stats (dict): If provided, filled with the number of generated tokens ('generated_tokens') and the generation time in seconds ('generation_time')
+            **kwargs: Additional keyword arguments. 'stop_sequences' (str or List[str]) stops the generation once one of them is generated, 
+                      the stop sequence is trimmed from the response.
 
         Returns:
             tuple:  The generated LLM response, a list of warnings, dict containg some debug info
@@ -77,11 +84,19 @@ class ModelClass:
         with warnings.catch_warnings(record=True) as warnings_list: # Collecting all the warnings so they can be passed to the API caller
             
             inputs =  self.tokenizer(question, return_tensors='pt')
-            eos_token_id = kwargs.pop('eos_token_id', self.MODEL_EOS_TOKENS_IDS)
-            generation_config = GenerationConfig(**self.generation_config.to_diff_dict())
-            generation_config.update(eos_token_id=eos_token_id, **kwargs)
-            outputs_encoded= self.model.generate(**inputs, do_sample = True, generation_config=generation_config ).to('cpu')
-            generated = self.tokenizer.batch_decode(outputs_encoded, skip_special_tokens=True)
+            eos_token_id = kwargs.pop('eos_token_id', [self.tokenizer.eos_token_id])
+            stop_sequences = self.get_stop_sequences(kwargs.pop('stop_sequences', None))
+            generation_config = self.clone_generation_config(self.generation_config, eos_token_id=eos_token_id, **kwargs)
+            generation_start = time.monotonic()
+            outputs_encoded= self.model.generate(**inputs, do_sample = True, generation_config=generation_config,
+                                                 **self.get_stop_sequences_kwargs(stop_sequences, generation_config)).to('cpu')
+            if generation_stats is not None:
+                # The decoder outputs start with the decoder start token, the decoder-only outputs with the prompt
+                prompt_len = 1 if self.model.config.is_encoder_decoder else inputs['input_ids'].shape[-1]
+                generation_stats['generated_tokens'] = outputs_encoded.shape[0] * (outputs_encoded.shape[-1] - prompt_len)
+                generation_stats['generation_time'] = time.monotonic() - generation_start
+            generated = [self.trim_stop_sequences(text, stop_sequences)
+                         for text in self.tokenizer.batch_decode(outputs_encoded, skip_special_tokens=True)]
             
         
         warning_messages = ' /n'.join([warn.message.__str__().strip() for warn in warnings_list])
@@ -94,48 +109,228 @@ class ModelClass:
                    'generation_config': generation_config.to_dict() } if debug else {}
          ) 
    
-    class StopOnTokens(StoppingCriteria):
-        """ Class needed for the streaming generation """
+    def embed(self, texts: List[str]) -> np.ndarray:
+        """
+        Computes normalized sentence embeddings with the encoder of the model (mean pooling of the last hidden states).
+
+        Parameters:
+            texts (List[str]): The texts to embed.
+
+        Returns:
+            np.ndarray: Array of shape (len(texts), hidden size), each row has a unit L2 norm.
+        """
+        inputs = self.tokenizer(texts, return_tensors='pt', padding=True, truncation=True)
+        with torch.no_grad():
+            hidden_states = self.model.get_encoder()(**inputs).last_hidden_state
+        mask = inputs['attention_mask'].unsqueeze(-1).to(hidden_states.dtype)
+        embeddings = (hidden_states * mask).sum(dim=1) / mask.sum(dim=1)
+        return torch.nn.functional.normalize(embeddings, dim=-1).cpu().numpy()
+   
+    class StopOnSequences(StoppingCriteria):
+        """ 
+        Stops the generation once every sequence of the batch ends with one of the stop sequences or is finished.
+        The stop sequences are matched with tensor operations on the last tokens of the whole batch. As the same text can be tokenized
+        differently in context, the rows not matched on the token ids fall back to a text check on their last decoded tokens.
+        If stop_end_ids is provided, only the rows whose last token is one of these ids (tokens that can end a stop sequence) are decoded.
+        """
+        def __init__(self, stop_sequences_ids: List[List[int]], finished_token_ids: List[int], stop_sequences: List[str] = None, tokenizer = None,
+                     stop_end_ids: List[int] = None):
+            max_len = max([len(sequence_ids) for sequence_ids in stop_sequences_ids], default=1)
+            # Stop sequences right-aligned in a (number of stop sequences, max_len) tensor, the left padding is masked out
+            self.stop_ids = torch.full((len(stop_sequences_ids), max_len), -1, dtype=torch.long)
+            for i, sequence_ids in enumerate(stop_sequences_ids):
+                self.stop_ids[i, max_len - len(sequence_ids):] = torch.tensor(sequence_ids, dtype=torch.long)
+            self.stop_mask = self.stop_ids >= 0
+            self.finished_token_ids = torch.tensor(finished_token_ids, dtype=torch.long)
+            self.stop_sequences = stop_sequences or []
+            self.tokenizer = tokenizer
+            self.stop_end_ids = torch.tensor(stop_end_ids, dtype=torch.long) if stop_end_ids is not None else None
+            # A token holds at least one character, so a stop sequence always fits in that many last tokens (plus one for a token starting before it)
+            self.text_tail_len = max([len(sequence) for sequence in self.stop_sequences], default=0) + 1
+            self._last_matches = (None, None, None) # The logits processor checks the same input_ids as the stopping criteria of the previous step
+
+        def matches_ids(self, input_ids: torch.LongTensor) -> torch.BoolTensor:
+            """ Returns a (batch size,) tensor, True for the sequences ending with the token ids of one of the stop sequences """
+            max_len = self.stop_ids.shape[-1]
+            tail = input_ids[:, -max_len:]
+            if tail.shape[-1] < max_len:
+                tail = torch.nn.functional.pad(tail, (max_len - tail.shape[-1], 0), value=-2)
+            stop_ids, stop_mask = self.stop_ids.to(input_ids.device), self.stop_mask.to(input_ids.device)
+            return ((tail[:, None, :] == stop_ids[None]) | ~stop_mask[None]).all(dim=-1).any(dim=-1)
+
+        def matches(self, input_ids: torch.LongTensor) -> torch.BoolTensor:
+            """ Returns a (batch size,) tensor, True for the sequences ending with one of the stop sequences """
+            shape, last_ids, matched = self._last_matches
+            if shape == input_ids.shape and torch.equal(last_ids, input_ids[:, -1]):
+                return matched
+            matched = self.matches_ids(input_ids)
+            if self.tokenizer is not None and self.stop_sequences and not matched.all():
+                candidates = ~matched
+                if self.stop_end_ids is not None:
+                    candidates &= torch.isin(input_ids[:, -1], self.stop_end_ids.to(input_ids.device))
+                rows = candidates.nonzero().flatten()
+                if len(rows):
+                    tails = self.tokenizer.batch_decode(input_ids[rows, -self.text_tail_len:], skip_special_tokens=True)
+                    text_matched = torch.tensor([any(sequence in tail for sequence in self.stop_sequences) for tail in tails], device=input_ids.device)
+                    matched = matched.clone()
+                    matched[rows] = text_matched
+            self._last_matches = (input_ids.shape, input_ids[:, -1].clone(), matched)
+            return matched
+
         def __call__(self, input_ids: torch.LongTensor, scores: torch.FloatTensor, **kwargs) -> bool:
-            stop_ids = [29, 0]
-            for stop_id in stop_ids:
-                if input_ids[0][-1] == stop_id:
-                    return True
-            return False
+            if input_ids.shape[-1] < 2: # Only the decoder start token
+                return False
+            finished = torch.isin(input_ids[:, -1], self.finished_token_ids.to(input_ids.device))
+            return bool((finished | self.matches(input_ids)).all())
+
+    class FinishOnStopSequences(LogitsProcessor):
+        """ 
+        Forces the eos token for the sequences ending with a stop sequence, so that each sequence of the batch finishes independently
+        """
+        def __init__(self, stop_criteria: 'ModelClass.StopOnSequences', eos_token_id: int):
+            self.stop_criteria = stop_criteria
+            self.eos_token_id = eos_token_id
+
+        def __call__(self, input_ids: torch.LongTensor, scores: torch.FloatTensor) -> torch.FloatTensor:
+            matched = self.stop_criteria.matches(input_ids)
+            if matched.any():
+                scores[matched] = -float('inf')
+                scores[matched, self.eos_token_id] = 0
+            return scores
+
+    @staticmethod
+    def clone_generation_config(generation_config: GenerationConfig, **kwargs) -> GenerationConfig:
+        """
+        Returns a copy of a generation config updated with the parameters of a request, the original config is left untouched.
+
+        Parameters:
+            generation_config (GenerationConfig): The config to copy, e.g. the default config of the model.
+            **kwargs: The generation parameters of the request.
+
+        Returns:
+            GenerationConfig: The updated copy.
+        """
+        cloned = GenerationConfig(**generation_config.to_diff_dict())
+        cloned.update(**kwargs)
+        return cloned
+
+    @staticmethod
+    def get_stop_sequences(stop_sequences: Union[str, List[str], None]) -> List[str]:
+        """ Returns the stop sequences of a request as a list """
+        if not stop_sequences:
+            return []
+        return [stop_sequences] if isinstance(stop_sequences, str) else [sequence for sequence in stop_sequences if sequence]
+
+    @staticmethod
+    def get_stop_end_ids(stop_sequences: List[str], token_texts: List[str]) -> Optional[List[int]]:
+        """
+        Returns the ids of the tokens that can end a stop sequence: a stop sequence first appears in the text when the token holding its last character
+        is generated. None if the tokens cannot be filtered, when a stop sequence ends with a whitespace that the tokenizer may merge into the next token.
+
+        Parameters:
+            stop_sequences (List[str]): The stop sequences.
+            token_texts (List[str]): Text of each token decoded on its own, indexed by token id.
+
+        Returns:
+            Optional[List[int]]: The ids of the tokens holding the last character of one of the stop sequences.
+        """
+        last_characters = {sequence[-1] for sequence in stop_sequences}
+        if any(character.isspace() for character in last_characters):
+            return None
+        return [token_id for token_id, text in enumerate(token_texts) if any(character in text for character in last_characters)]
+
+    def get_stop_sequences_kwargs(self, stop_sequences: List[str], generation_config: GenerationConfig) -> dict:
+        """
+        Returns the stopping criteria and logits processor stopping the generation on the stop sequences.
+
+        Parameters:
+            stop_sequences (List[str]): The stop sequences.
+            generation_config (GenerationConfig): The generation config of the request.
+
+        Returns:
+            dict: The keyword arguments to pass to generate, empty if there are no stop sequences.
+        """
+        if not stop_sequences:
+            return {}
+        stop_sequences_ids = [ids for ids in self.tokenizer(stop_sequences, add_special_tokens=False)['input_ids'] if ids]
+        eos_token_id = generation_config.eos_token_id
+        eos_token_ids = eos_token_id if isinstance(eos_token_id, list) else [eos_token_id]
+        finished_token_ids = eos_token_ids + ([generation_config.pad_token_id] if generation_config.pad_token_id is not None else [])
+        stop_criteria = self.StopOnSequences(stop_sequences_ids, finished_token_ids, stop_sequences=stop_sequences, tokenizer=self.tokenizer,
+                                             stop_end_ids=self.get_stop_end_ids(stop_sequences, self.token_texts))
+        return {'stopping_criteria': StoppingCriteriaList([stop_criteria]),
+                'logits_processor': LogitsProcessorList([self.FinishOnStopSequences(stop_criteria, eos_token_ids[0])])}
+
+    @staticmethod
+    def trim_stop_sequences(text: str, stop_sequences: List[str]) -> str:
+        """ Trims the text from the first stop sequence found """
+        positions = [position for position in (text.find(sequence) for sequence in stop_sequences) if position >= 0]
+        return text[:min(positions)] if positions else text
+
+    @staticmethod
+    def stop_sequence_prefix_len(text: str, stop_sequences: List[str]) -> int:
+        """ Returns the length of the longest end of the text that could be the beginning of a stop sequence """
+        return max([length for sequence in stop_sequences for length in range(1, len(sequence)) if text.endswith(sequence[:length])], default=0)
         
-    def ask_llm_stream(self, question: str, **kwargs) -> Generator[str, None, None]:
+    class CountingTextIteratorStreamer(TextIteratorStreamer):
+        """ TextIteratorStreamer counting the generated tokens """
+        def __init__(self, *args, **kwargs):
+            super().__init__(*args, **kwargs)
+            self.generated_tokens = 0
+
+        def put(self, value):
+            if not (self.skip_prompt and self.next_tokens_are_prompt):
+                self.generated_tokens += value.shape[-1]
+            super().put(value)
+
+    def ask_llm_stream(self, question: str, generation_stats: dict = None, **kwargs) -> Generator[str, None, None]:
         """ 
         Returns a Generator providing the response from the llm in a streaming manner 
         
          Parameters:
             question (str): The input question
-            **kwargs: Additional keyword arguments.
+            generation_stats (dict): If provided, filled with the number of generated tokens ('generated_tokens') and the generation time in seconds ('generation_time')
+                                     once the streaming is over
+            **kwargs: Additional keyword arguments. 'stop_sequences' (str or List[str]) stops the generation once one of them is generated, 
+                      the stop sequence is trimmed from the response.
 
         Returns:
             generator:  The generated LLM response
         
         """
-        stop = self.StopOnTokens()
+        stop_sequences = self.get_stop_sequences(kwargs.pop('stop_sequences', None))
         model_inputs = self.tokenizer(question, return_tensors='pt')
         # Setting up the streamer on a separate Thread to fetch words in a non blocking way, 
         # see for more details : https://huggingface.co/docs/transformers/v4.31.0/en/internal/generation_utils#transformers.TextIteratorStreamer 
 
-        streamer = TextIteratorStreamer(self.tokenizer, timeout=10., skip_prompt=True, skip_special_tokens=True)
-        generation_config = GenerationConfig(**self.generation_config.to_diff_dict())
-        generation_config.update(**kwargs)
+        streamer = self.CountingTextIteratorStreamer(self.tokenizer, timeout=10., skip_prompt=True, skip_special_tokens=True)
+        generation_config = self.clone_generation_config(self.generation_config, **kwargs)
         generation_config.update(num_beams = 1) # Mandatory for streaming generation, overriding any user settings 
         generate_kwargs = dict(
                                 model_inputs,
                                 streamer=streamer,
                                 generation_config = generation_config,
-                                stopping_criteria=StoppingCriteriaList([stop])
+                                **self.get_stop_sequences_kwargs(stop_sequences, generation_config)
                                 )
         
         t = Thread(target=self.model.generate, kwargs=generate_kwargs)
+        generation_start = time.monotonic()
         t.start()
 
-        partial_message  = ""
-        for new_token in streamer:
-            if new_token != '<':
-                partial_message += new_token
-                yield partial_message 
+        try:
+            partial_message  = ""
+            for new_token in streamer:
+                if new_token != '<':
+                    partial_message += new_token
+                    trimmed_message = self.trim_stop_sequences(partial_message, stop_sequences)
+                    if len(trimmed_message) < len(partial_message):
+                        yield trimmed_message
+                        return
+                    # Holding back the end of the message while it could still become a stop sequence
+                    yield partial_message[:len(partial_message) - self.stop_sequence_prefix_len(partial_message, stop_sequences)]
+            if stop_sequences:
+                yield partial_message # Releasing the end of the message held back
+        finally:
+            if generation_stats is not None:
+                generation_stats['generated_tokens'] = streamer.generated_tokens
+                generation_stats['generation_time'] = time.monotonic() - generation_start
@@ -1,15 +1,21 @@
 import warnings
+from contextlib import nullcontext
 from src.backend.llm import ModelClass
 from src.backend.llm_dialog import LlamaDialog
+from src.backend.llm_governor import GenerationGovernor
+from src.backend.llm_profiler import LLMProfiler
+from src.backend.llm_semantic_cache import SemanticCache
 from pydantic import BaseModel
-from typing import Dict, Union
+from typing import Dict, Generator, Union
 from transformers import GenerationConfig
 
 """
 Data model for making  LLMCalls
 
-provides two methods:
-ask_llm (ModelClass, list[LlamaDialogs]): gets a dialog, asks the question to the llm, and updates the conversation history
+provides the following methods:
+ask_llm (ModelClass, list[LlamaDialogs], LLMProfiler, SemanticCache, GenerationGovernor): gets a dialog, asks the question to the llm, and updates the conversation history. Profiles the generation if requested,
+    answers near duplicates of previous first-turn questions from the semantic cache and caps the generation parameters under high load
+ask_llm_stream (ModelClass, list[LlamaDialogs], GenerationGovernor): same as ask_llm, but returns a generator streaming the response
 __get_dialog (dialogs): returns a dialog coresponding the the uuid from the LLMCall or creates a new one if not found 
 
 """
@@ -18,6 +24,7 @@ __get_dialog (dialogs): returns a dialog coresponding the the uuid from the LLMC
 class LLMCall(BaseModel):
     """
     Data model for the request to the "/ask" endpoint.
+    The generation parameters can include 'stop_sequences' (str or list of str) to stop the generation on them.
     """
     question: str
     uuid: str = None
@@ -36,14 +43,26 @@ class LLMCall(BaseModel):
             dialog = [ditem for ditem in dialogs if ditem.UUID == self.uuid][0]
         except IndexError:
             warnings.warn(f"Dialog uuid {self.uuid} not found. Creating a new dialog")
-            dialog = LlamaDialog(no_history=self.no_history)
+            # Keeping the requested uuid, so that a router can pick the uuid of a new dialog and send all its requests to the same instance
+            dialog = LlamaDialog(no_history=self.no_history, **({'UUID': self.uuid} if self.uuid else {}))
             dialogs.append(dialog)
             self.uuid = dialog.UUID
         return dialog
+
+    def __prepare_dialog(self, dialogs: list[LlamaDialog]) -> LlamaDialog:
+        # Adding the system prompt and the question to the dialog
+        dialog = self.__get_dialog(dialogs)
+        if self.system_prompt:
+            dialog.supplement_system_prompt(extra_system_prompt=self.system_prompt)
+        dialog.user_ask(self.question)
+        return dialog
             
     def ask_llm(self, 
                 llm: ModelClass, 
-                dialogs: list[LlamaDialog]
+                dialogs: list[LlamaDialog],
+                profiler: LLMProfiler = None,
+                semantic_cache: SemanticCache = None,
+                governor: GenerationGovernor = None
                 ) -> tuple:
         """
         Ask the LLM a question and handle the conversation history.
@@ -51,18 +70,69 @@ class LLMCall(BaseModel):
         Parameters:
             llm (ModelClass): ModelClass model to prompt
             dialogs (list[LlamaDialog]): List of all dialogs
+            profiler (LLMProfiler): If provided, captures profiling traces for debug requests or a sampled fraction of the requests
+            semantic_cache (SemanticCache): If provided, first-turn and no_history questions are answered from the cache when a near duplicate was already asked
+            governor (GenerationGovernor): If provided, caps the generation parameters according to the server load
 
         Returns:
             tuple: A tuple containing the LLM response (str), the UUID (str) of the dialog, any warning messages to pass onto the API caller and debug information if requested.
         """
         print('\n\n\n\nHI LOIC\n\n\n\n\n')
-        dialog = self.__get_dialog(dialogs)
-        # Adding to the system prompt
-        if self.system_prompt:
-            dialog.supplement_system_prompt(extra_system_prompt=self.system_prompt)
-        # Expanding the conversation
-        dialog.user_ask(self.question)
-        formated_dialog = dialog.get_llm_formated_dialog() # reformats the question to specific LLama 2 format 
-        result, warning_messages, debug_info = llm.ask_llm(formated_dialog, debug=self.debug, **self.generation_parameters)
+        with governor.track() if governor else nullcontext(None) as generation_record: # Counting the request as in flight as soon as it arrives
+            dialog = self.__prepare_dialog(dialogs)
+            formated_dialog = dialog.get_llm_formated_dialog() # reformats the question to specific LLama 2 format 
+            result, cache_embedding = None, None
+            if semantic_cache is not None and len(dialog.dialog) == 2: # Only the system prompt and the question, the answer does not depend on any history
+                cache_context = dialog.dialog[0].content + str(self.generation_parameters)
+                cache_embedding = semantic_cache.embed(self.question)
+                result, cache_info = semantic_cache.lookup(cache_embedding, cache_context)
+            if result is not None:
+                warning_messages, debug_info = '', {}
+                if self.debug and profiler is not None:
+                    debug_info['profiling'] = {'skipped': 'semantic cache hit'}
+            else:
+                generation_parameters, governor_warnings = governor.adjust(self.generation_parameters) if governor else (self.generation_parameters or {}, [])
+                profiling_info = {}
+                with profiler.capture(self.uuid, debug=self.debug, profiling_info=profiling_info) if profiler else nullcontext():
+                    result, warning_messages, debug_info = llm.ask_llm(formated_dialog, debug=self.debug, generation_stats=generation_record, **generation_parameters)
+                warning_messages = ' /n'.join([message for message in [warning_messages] + governor_warnings if message])
+                if self.debug and profiling_info: # Sampled requests are profiled too, but only debug requests get the trace names back
+                    debug_info['profiling'] = profiling_info
+                if cache_embedding is not None and not governor_warnings: # An answer generated with capped parameters is not cached for the requested ones
+                    semantic_cache.add(cache_embedding, cache_context, self.question, result)
+        if cache_embedding is not None and self.debug:
+            debug_info['semantic_cache'] = cache_info
         dialog.assistant_reply(result)
         return result, self.uuid, warning_messages, debug_info
+
+    def ask_llm_stream(self,
+                       llm: ModelClass,
+                       dialogs: list[LlamaDialog],
+                       governor: GenerationGovernor = None,
+                       generation_record: Dict = None
+                       ) -> tuple:
+        """
+        Ask the LLM a question and stream the response. The conversation history is updated once the streaming is over.
+
+        Parameters:
+            llm (ModelClass): ModelClass model to prompt
+            dialogs (list[LlamaDialog]): List of all dialogs
+            governor (GenerationGovernor): If provided, caps the generation parameters according to the server load
+            generation_record (Dict): If provided, the record returned by governor.start, filled with the generation stats. The generator may never be
+                                      iterated (e.g. the client disconnects first), so the caller releases the record with governor.finish once the response is over.
+
+        Returns:
+            tuple: A tuple containing a generator of the new pieces of the LLM response (str), the UUID (str) of the dialog and a list of warning messages.
+        """
+        dialog = self.__prepare_dialog(dialogs)
+        formated_dialog = dialog.get_llm_formated_dialog()
+        generation_parameters, warning_messages = governor.adjust(self.generation_parameters) if governor else (self.generation_parameters or {}, [])
+
+        def stream() -> Generator[str, None, None]:
+            partial_message = ''
+            for response in llm.ask_llm_stream(formated_dialog, generation_stats=generation_record, **generation_parameters):
+                yield response[len(partial_message):]
+                partial_message = response
+            dialog.assistant_reply(partial_message)
+
+        return stream(), self.uuid, warning_messages
@@ -61,6 +61,7 @@ class LlamaDialog(BaseModel):
     Attributes:
         UUID (str): Universally Unique Identifier for the dialog.
         no_history (bool): Flag indicating whether to retain the conversation history (default: False).
+        pinned (bool): Flag indicating that the dialog must stay on the instance that created it, e.g. the Gradio chat dialogs (default: False).
         creation_datetime (datetime): Creation datetime of the dialog (defaults to current datetime).
         system_prompt (str): The system prompt for the conversation.
         dialog (List[DialogEvent]): List of events representing the conversation.
@@ -87,6 +88,7 @@ class LlamaDialog(BaseModel):
 
     UUID: str = Field(default_factory=uuid_factory)
     no_history: bool = False
+    pinned: bool = False
     creation_datetime: datetime = datetime.now()
     system_prompt : str = '''
     You are a helpful, respectful and honest assistant. 
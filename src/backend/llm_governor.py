@@ -0,0 +1,197 @@
+import json
+import time
+
+from collections import deque
+from contextlib import contextmanager
+from threading import Lock
+from typing import Dict, Generator, List, Optional, Tuple
+
+from pydantic import BaseModel
+
+
+"""
+Load-adaptive governor stepping the generation settings down when the server is under pressure.
+
+Classes:
+- DegradationLevel: Data model for one step of the degradation policy: when it applies and which generation settings it caps.
+- GenerationGovernor: Tracks the number of requests in flight (queued or generating) and the recent tokens/s. Before a generation, caps the
+                      generation parameters according to the most severe level that applies, and restores them once the load drops.
+
+"""
+
+
+class DegradationLevel(BaseModel):
+    """
+    Data model for a step of the degradation policy.
+
+    Attributes:
+        queue_depth (int): The level applies when at least this number of requests are in flight (queued or generating, including the request being adjusted).
+        min_tokens_per_second (float): The level also applies when the recent throughput falls below this value (optional).
+        max_new_tokens (int): Cap on the number of generated tokens (optional).
+        num_beams (int): Cap on the number of beams (optional).
+        top_k (int): Cap on top_k (optional).
+        max_time (float): Cap on the generation time, in seconds (optional).
+    """
+    queue_depth: int
+    min_tokens_per_second: Optional[float] = None
+    max_new_tokens: Optional[int] = None
+    num_beams: Optional[int] = None
+    top_k: Optional[int] = None
+    max_time: Optional[float] = None
+
+
+DEFAULT_POLICY: List[DegradationLevel] = [
+    DegradationLevel(queue_depth=4, max_new_tokens=512, num_beams=1),
+    DegradationLevel(queue_depth=8, max_new_tokens=256, num_beams=1, top_k=50, max_time=30.),
+    DegradationLevel(queue_depth=16, max_new_tokens=128, num_beams=1, top_k=50, max_time=15.),
+]
+
+CAPPED_PARAMETERS: List[str] = ['max_new_tokens', 'num_beams', 'top_k', 'max_time']
+
+
+class GenerationGovernor:
+    """
+    Caps the generation parameters according to the current load.
+
+    Attributes:
+        policy (List[DegradationLevel]): Levels of the degradation policy, from the least to the most severe.
+        window (float): Duration of the window used to compute the recent tokens/s, in seconds.
+        defaults (Dict): Default generation parameters of the model (e.g. ModelClass.generation_config.to_dict()), used for the parameters not sent by the client.
+        adjustments (Dict[int, int]): Number of adjusted generations for each level.
+    """
+
+    def __init__(self, policy: List[DegradationLevel] = None, window: float = 30., defaults: Dict = None):
+        self.policy = sorted(policy if policy is not None else DEFAULT_POLICY, key=lambda level: level.queue_depth)
+        self.window = window
+        self.defaults = defaults or {}
+        self.adjustments = {level: 0 for level in range(len(self.policy))}
+        self._in_flight = 0
+        self._generations = deque()  # (end time, generated tokens, duration) of the recent generations
+        self._lock = Lock()
+
+    @classmethod
+    def from_json(cls, path: str, **kwargs) -> 'GenerationGovernor':
+        """
+        Creates a governor with a policy read from a json file (list of DegradationLevel).
+
+        Parameters:
+            path (str): Path to the json file.
+            **kwargs: Additional keyword arguments.
+
+        Returns:
+            GenerationGovernor: The governor.
+        """
+        with open(path) as policy_file:
+            policy = [DegradationLevel(**level) for level in json.load(policy_file)]
+        return cls(policy=policy, **kwargs)
+
+    @property
+    def queue_depth(self) -> int:
+        return self._in_flight
+
+    @property
+    def tokens_per_second(self) -> Optional[float]:
+        """
+        Recent throughput of the generations, None if no generation ended within the window.
+        """
+        with self._lock:
+            self._drop_old_generations()
+            duration = sum(generation[2] for generation in self._generations)
+            return sum(generation[1] for generation in self._generations) / duration if duration > 0 else None
+
+    def _drop_old_generations(self) -> None:
+        while self._generations and self._generations[0][0] < time.monotonic() - self.window:
+            self._generations.popleft()
+
+    def current_level(self) -> Optional[int]:
+        """
+        Returns the index of the most severe level that applies to the current load, None if the full settings can be used.
+        """
+        queue_depth, tokens_per_second = self.queue_depth, self.tokens_per_second
+        current = None
+        for index, level in enumerate(self.policy):
+            if (queue_depth >= level.queue_depth
+                    or (level.min_tokens_per_second is not None and tokens_per_second is not None and tokens_per_second < level.min_tokens_per_second)):
+                current = index
+        return current
+
+    def adjust(self, generation_parameters: Dict) -> Tuple[Dict, List[str]]:
+        """
+        Caps the generation parameters according to the current load. A parameter is only capped, reported and counted when its value,
+        or the default of the model if it was not sent, is above the cap.
+
+        Parameters:
+            generation_parameters (Dict): The generation parameters sent by the client.
+
+        Returns:
+            tuple: The adjusted generation parameters and a list of warnings describing the adjustments.
+        """
+        generation_parameters = dict(generation_parameters or {})
+        level_index = self.current_level()
+        if level_index is None:
+            return generation_parameters, []
+
+        level = self.policy[level_index]
+        warning_messages = []
+        for parameter in CAPPED_PARAMETERS:
+            cap = getattr(level, parameter)
+            requested = generation_parameters.get(parameter)
+            value = requested if requested is not None else self.defaults.get(parameter)
+            if cap is not None and (value is None or value > cap): # No value means no limit, e.g. max_time
+                generation_parameters[parameter] = cap
+                warning_messages.append(f"High server load: {parameter} limited to {cap}"
+                                        + (f" (requested {requested})" if requested is not None else f" (default {value})" if value is not None else ''))
+        if warning_messages:
+            with self._lock:
+                self.adjustments[level_index] += 1
+        return generation_parameters, warning_messages
+
+    def start(self) -> Dict:
+        """
+        Counts a request as in flight, as soon as it arrives. Must be called before adjust, and followed by finish once the request is over.
+
+        Returns:
+            Dict: The record of the request. The number of generated tokens ('generated_tokens') and the generation time in seconds ('generation_time')
+                  can be set in it, to be accounted in the recent tokens/s. It can be passed as generation_stats to ModelClass.ask_llm and ModelClass.ask_llm_stream.
+        """
+        with self._lock:
+            self._in_flight += 1
+        return {'start': time.monotonic()}
+
+    def finish(self, record: Dict) -> None:
+        """
+        Counts a request as over, and accounts its generated tokens in the recent tokens/s.
+
+        Parameters:
+            record (Dict): The record returned by start.
+        """
+        with self._lock:
+            self._in_flight -= 1
+            if record.get('generated_tokens'): # Requests answered without a generation (e.g. from the cache) do not reflect the throughput
+                duration = record.get('generation_time', time.monotonic() - record['start'])
+                self._generations.append((time.monotonic(), record['generated_tokens'], duration))
+            self._drop_old_generations()
+
+    @contextmanager
+    def track(self) -> Generator[Dict, None, None]:
+        """
+        Context manager counting a request as in flight, see start and finish.
+        """
+        record = self.start()
+        try:
+            yield record
+        finally:
+            self.finish(record)
+
+    def status(self) -> Dict:
+        """
+        Returns the current load and the adjustments made so far.
+
+        Returns:
+            Dict: The number of requests in flight, recent tokens/s, current level, number of adjusted generations per level and the policy.
+        """
+        return {'queue_depth': self.queue_depth,
+                'tokens_per_second': self.tokens_per_second,
+                'level': self.current_level(),
+                'adjustments': self.adjustments,
+                'policy': [level.model_dump() for level in self.policy]}
@@ -0,0 +1,210 @@
+import json
+import os
+import random
+import sys
+import time
+
+from contextlib import contextmanager, nullcontext
+from datetime import datetime
+from threading import Event, Lock, Thread, get_ident
+from typing import Dict, Generator, List, Optional
+
+import torch
+
+
+"""
+On-demand profiling of single LLM requests.
+
+Classes:
+- StackSampler: A lightweight Python sampling profiler. A background thread periodically records the stack of the profiled thread
+                and writes the samples as a Chrome trace.
+- LLMProfiler: Decides which requests get profiled (debug requests or a sampled fraction of the traffic) and captures both a
+               torch.profiler trace and a Python sampling trace for them. Traces are written in Chrome-trace format
+               (open them in chrome://tracing or https://ui.perfetto.dev).
+
+When no capture is requested, LLMProfiler.capture returns a nullcontext, so the profiler adds no overhead to regular requests.
+"""
+
+
+class StackSampler:
+    """
+    Sampling profiler recording the Python stack of a single thread at a fixed interval.
+
+    Attributes:
+        thread_id (int): Identifier of the thread to sample.
+        interval (float): Time between two samples, in seconds.
+        samples (List[tuple]): Recorded samples, as (timestamp in microseconds, stack from outermost to innermost frame).
+    """
+
+    def __init__(self, thread_id: int, interval: float = 0.005):
+        self.thread_id = thread_id
+        self.interval = interval
+        self.samples = []
+        self._stop_event = Event()
+        self._thread = Thread(target=self._run, daemon=True)
+
+    def _run(self) -> None:
+        while not self._stop_event.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{frame.f_lineno})")
+                frame = frame.f_back
+            self.samples.append((time.perf_counter_ns() // 1000, stack[::-1]))
+
+    def start(self) -> None:
+        self._thread.start()
+
+    def stop(self) -> None:
+        self._stop_event.set()
+        self._thread.join()
+
+    def export_chrome_trace(self, path: str) -> None:
+        """
+        Writes the samples as a Chrome trace. Consecutive samples sharing the same frame at the same depth are merged into a single event,
+        so the trace reads like a flame chart.
+
+        Parameters:
+            path (str): Path of the json file to write.
+        """
+        interval_us = int(self.interval * 1e6)
+        events = []
+        open_frames = []  # [name, start timestamp, end timestamp] for each depth of the current stack
+        for timestamp, stack in self.samples:
+            common_depth = 0
+            while (common_depth < min(len(stack), len(open_frames))
+                   and open_frames[common_depth][0] == stack[common_depth]):
+                open_frames[common_depth][2] = timestamp + interval_us
+                common_depth += 1
+            for name, start, end in open_frames[common_depth:]:
+                events.append({'name': name, 'ph': 'X', 'ts': start, 'dur': end - start, 'pid': os.getpid(), 'tid': self.thread_id})
+            open_frames = open_frames[:common_depth] + [[name, timestamp, timestamp + interval_us] for name in stack[common_depth:]]
+        for name, start, end in open_frames:
+            events.append({'name': name, 'ph': 'X', 'ts': start, 'dur': end - start, 'pid': os.getpid(), 'tid': self.thread_id})
+
+        with open(path, 'w') as trace_file:
+            json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, trace_file)
+
+
+class LLMProfiler:
+    """
+    Captures profiling traces for single requests.
+
+    Attributes:
+        trace_dir (str): Local directory where the traces are written.
+        sample_rate (float): Fraction of the requests to profile, in [0, 1] (default: 0, only debug requests are profiled).
+        profile_debug (bool): If True, every request with the debug flag is profiled.
+        sampling_interval (float): Interval of the Python sampling profiler, in seconds.
+        max_captures (int): Maximum number of captures kept on disk (each capture writes a torch and a python trace), the oldest ones are removed first.
+    """
+
+    def __init__(self,
+                 trace_dir: str = 'traces',
+                 sample_rate: float = 0.0,
+                 profile_debug: bool = True,
+                 sampling_interval: float = 0.005,
+                 max_captures: int = 50):
+        self.trace_dir = trace_dir
+        self.sample_rate = sample_rate
+        self.profile_debug = profile_debug
+        self.sampling_interval = sampling_interval
+        self.max_captures = max_captures
+        self._lock = Lock()  # torch.profiler does not support concurrent profiling sessions
+
+    def should_capture(self, debug: bool = False) -> bool:
+        """
+        Decides if a request should be profiled.
+
+        Parameters:
+            debug (bool): Debug flag of the request.
+
+        Returns:
+            bool: True if the request should be profiled.
+        """
+        return (debug and self.profile_debug) or (self.sample_rate > 0 and random.random() < self.sample_rate)
+
+    def capture(self, name: str, debug: bool = False, profiling_info: Optional[Dict] = None):
+        """
+        Returns a context manager profiling the enclosed code if the request is selected, a nullcontext otherwise.
+
+        Parameters:
+            name (str): Name used as prefix for the trace files (e.g. the dialog uuid).
+            debug (bool): Debug flag of the request.
+            profiling_info (Dict): If provided, filled with the names of the written trace files ('trace_files'),
+                                   or with the reason why a debug request was not profiled ('skipped').
+
+        Returns:
+            A context manager.
+        """
+        profiling_info = profiling_info if profiling_info is not None else {}
+        if not self.should_capture(debug):
+            return nullcontext()
+        if not self._lock.acquire(blocking=False):
+            if debug:
+                profiling_info['skipped'] = 'capture in progress'
+            return nullcontext()
+        return self._profile(name, profiling_info)
+
+    @contextmanager
+    def _profile(self, name: str, profiling_info: Dict) -> Generator[None, None, None]:
+        try:
+            os.makedirs(self.trace_dir, exist_ok=True)
+            prefix = f"{datetime.now().strftime('%Y%m%d-%H%M%S-%f')}_{name}"
+            activities = [torch.profiler.ProfilerActivity.CPU]
+            if torch.cuda.is_available():
+                activities.append(torch.profiler.ProfilerActivity.CUDA)
+            sampler = StackSampler(get_ident(), interval=self.sampling_interval)
+            with torch.profiler.profile(activities=activities, record_shapes=True) as torch_profile:
+                sampler.start()
+                try:
+                    yield
+                finally:
+                    sampler.stop()
+            profiling_info['trace_files'] = []
+            for suffix, export in (('torch', torch_profile.export_chrome_trace), ('python', sampler.export_chrome_trace)):
+                file_name = f"{prefix}_{suffix}.json"
+                export(os.path.join(self.trace_dir, file_name))
+                profiling_info['trace_files'].append(file_name)
+            self._remove_old_captures()
+        finally:
+            self._lock.release()
+
+    def _remove_old_captures(self) -> None:
+        # The trace files of a capture share the same prefix, starting with the capture datetime
+        captures = sorted({trace['name'].rsplit('_', 1)[0] for trace in self.list_traces()}, reverse=True)
+        old_captures = set(captures[self.max_captures:])
+        for trace in self.list_traces():
+            if trace['name'].rsplit('_', 1)[0] in old_captures:
+                os.remove(os.path.join(self.trace_dir, trace['name']))
+
+    def list_traces(self) -> List[Dict]:
+        """
+        Lists the traces available in the trace directory, most recent first.
+
+        Returns:
+            List[Dict]: name, size in bytes and creation datetime of each trace.
+        """
+        if not os.path.isdir(self.trace_dir):
+            return []
+        traces = []
+        for file_name in os.listdir(self.trace_dir):
+            if file_name.endswith('.json'):
+                stat = os.stat(os.path.join(self.trace_dir, file_name))
+                traces.append({'name': file_name, 'size': stat.st_size, 'creation_datetime': datetime.fromtimestamp(stat.st_mtime)})
+        return sorted(traces, key=lambda trace: trace['creation_datetime'], reverse=True)
+
+    def get_trace_path(self, name: str) -> str:
+        """
+        Returns the path of a trace, making sure it is located inside the trace directory.
+
+        Parameters:
+            name (str): Name of the trace file.
+
+        Returns:
+            str: Path to the trace file.
+        """
+        path = os.path.join(self.trace_dir, os.path.basename(name))
+        if not os.path.isfile(path):
+            raise(FileNotFoundError(f"Trace {name} not found"))
+        return path
@@ -0,0 +1,154 @@
+from threading import Lock
+from typing import Callable, List, Optional, Tuple
+
+import numpy as np
+
+
+"""
+Semantic cache returning the answer of a previous question when a new question is a near duplicate (e.g. a paraphrase) of it.
+
+Classes:
+- SemanticCache: Keeps the embeddings of the cached questions in a fixed size NumPy array and looks up the most similar one
+                 with a single matrix-vector product. Only entries sharing the same context (system prompt and generation parameters)
+                 can be matched. The least recently used entry is evicted when the cache is full.
+
+"""
+
+
+class SemanticCache:
+    """
+    Near-duplicate cache for LLM answers.
+
+    Attributes:
+        embed_fn (Callable): Function returning normalized embeddings for a list of texts (e.g. ModelClass.embed).
+        similarity_threshold (float): Minimum cosine similarity between two questions to return the cached answer. The default (0.95) favors
+                                      precision over hit rate: a paraphrase ("What is the largest country in the world?" / "Which country is the
+                                      largest in the world?") should score above it, while an entity swap ("... in the world?" / "... in Europe?")
+                                      shares most of its tokens and can score almost as high with mean-pooled encoder states, which are not trained
+                                      for sentence similarity. The default is not tuned for a given model: check such pairs with the diagnostics
+                                      (similarity, second_similarity, near_misses) before lowering it, and raise it if entity swaps are matched.
+        max_size (int): Maximum number of cached answers.
+        near_miss_margin (float): Misses with a similarity within this margin of the threshold are counted as near misses,
+                                  to help tuning the threshold.
+        hits (int): Number of cache hits.
+        misses (int): Number of cache misses.
+        near_misses (int): Number of misses close to the threshold.
+    """
+
+    def __init__(self,
+                 embed_fn: Callable[[List[str]], np.ndarray],
+                 similarity_threshold: float = 0.95,
+                 max_size: int = 1000,
+                 near_miss_margin: float = 0.02):
+        self.embed_fn = embed_fn
+        self.similarity_threshold = similarity_threshold
+        self.max_size = max_size
+        self.near_miss_margin = near_miss_margin
+        self.hits = 0
+        self.misses = 0
+        self.near_misses = 0
+        self._lock = Lock()
+        self._clear()
+
+    def _clear(self) -> None:
+        self._embeddings = None  # Allocated on the first insertion, once the embedding size is known
+        self._context_keys = np.zeros(self.max_size, dtype=np.int64)
+        self._last_used = np.zeros(self.max_size, dtype=np.int64)
+        self._questions = [None] * self.max_size
+        self._answers = [None] * self.max_size
+        self._size = 0
+        self._clock = 0
+
+    def clear(self) -> None:
+        """
+        Removes all the cached answers.
+        """
+        with self._lock:
+            self._clear()
+
+    def __len__(self) -> int:
+        return self._size
+
+    def embed(self, question: str) -> np.ndarray:
+        """
+        Embeds a question.
+
+        Parameters:
+            question (str): The question to embed.
+
+        Returns:
+            np.ndarray: The normalized embedding of the question.
+        """
+        return np.asarray(self.embed_fn([question])[0], dtype=np.float32)
+
+    def lookup(self, embedding: np.ndarray, context: str) -> Tuple[Optional[str], dict]:
+        """
+        Looks up the answer of the most similar cached question sharing the same context.
+
+        Parameters:
+            embedding (np.ndarray): The embedding of the question, as returned by embed.
+            context (str): Everything other than the question that shapes the answer (system prompt, generation parameters).
+
+        Returns:
+            tuple: The cached answer (None if there is no hit) and a dictionary of diagnostics.
+        """
+        with self._lock:
+            self._clock += 1
+            best_similarity, second_similarity, cached_question, answer = None, None, None, None
+            if self._size:
+                similarities = self._embeddings[:self._size] @ embedding
+                similarities[self._context_keys[:self._size] != hash(context)] = -np.inf
+                best = int(np.argmax(similarities))
+                if np.isfinite(similarities[best]):
+                    best_similarity = float(similarities[best])
+                    cached_question = self._questions[best]
+                    if self._size > 1:
+                        second = np.partition(similarities, -2)[-2]
+                        second_similarity = float(second) if np.isfinite(second) else None
+                    if best_similarity >= self.similarity_threshold:
+                        answer = self._answers[best]
+                        self._last_used[best] = self._clock
+
+            if answer is not None:
+                self.hits += 1
+            else:
+                self.misses += 1
+                if best_similarity is not None and best_similarity >= self.similarity_threshold - self.near_miss_margin:
+                    self.near_misses += 1
+
+            diagnostics = {'hit': answer is not None,
+                           'similarity': best_similarity,
+                           # A second entry close to the best one means the question is ambiguous, a likely source of false positives
+                           'second_similarity': second_similarity,
+                           'threshold': self.similarity_threshold,
+                           'cached_question': cached_question,
+                           'size': self._size,
+                           'hits': self.hits,
+                           'misses': self.misses,
+                           'near_misses': self.near_misses}
+        return answer, diagnostics
+
+    def add(self, embedding: np.ndarray, context: str, question: str, answer: str) -> None:
+        """
+        Adds an answer to the cache, evicting the least recently used entry if the cache is full.
+
+        Parameters:
+            embedding (np.ndarray): The embedding of the question, as returned by embed.
+            context (str): Everything other than the question that shapes the answer (system prompt, generation parameters).
+            question (str): The question.
+            answer (str): The answer of the LLM.
+        """
+        with self._lock:
+            if self._embeddings is None:
+                self._embeddings = np.zeros((self.max_size, embedding.shape[-1]), dtype=np.float32)
+            if self._size < self.max_size:
+                index = self._size
+                self._size += 1
+            else:
+                index = int(np.argmin(self._last_used))
+            self._clock += 1
+            self._embeddings[index] = embedding
+            self._context_keys[index] = hash(context)
+            self._last_used[index] = self._clock
+            self._questions[index] = question
+            self._answers[index] = answer
@@ -3,7 +3,9 @@ from gradio import Blocks
 
 from src.backend.llm import ModelClass
 from src.backend.llm_dialog import LlamaDialog
+from src.backend.llm_governor import GenerationGovernor
 
+from contextlib import nullcontext
 from typing import Tuple, Callable, List
 
 
@@ -15,7 +17,7 @@ CSS : str ="""
 footer {visibility: hidden}
 """
 
-def create_chat_interface(delete_dialog: Callable, llm: ModelClass, dialogs: List[LlamaDialog] ) -> Blocks:
+def create_chat_interface(delete_dialog: Callable, llm: ModelClass, dialogs: List[LlamaDialog], governor: GenerationGovernor = None) -> Blocks:
     """
     Create a chat interface with the LLM model using the Gradio Blocks
 
@@ -23,6 +25,7 @@ def create_chat_interface(delete_dialog: Callable, llm: ModelClass, dialogs: Lis
             delete_dialog (callable): dunction to delete a dialog, used by the clear button in the interface.
             llm (ModelClass): the llm model to call
             dialogs (List[LlamaDialog]): global list of all the active dialogs 
+            governor (GenerationGovernor): if provided, caps the generation parameters according to the server load
 
     Returns:
             Blocks:  The chat interface
@@ -77,7 +80,7 @@ def create_chat_interface(delete_dialog: Callable, llm: ModelClass, dialogs: Lis
                 dialog = [ditem for ditem in dialogs if ditem.UUID == uu_id]
                 dialog = dialog[0] if isinstance(dialog, list) else dialog
             else:
-                dialog = LlamaDialog()
+                dialog = LlamaDialog(pinned=True) # The chat is served by this instance only, its dialogs are never moved
             return dialog
 
         def get_system_prompt(uu_id: str = None, system_prompt_radio: str = 'Extend') -> Tuple[str, str]:
@@ -97,21 +100,28 @@ def create_chat_interface(delete_dialog: Callable, llm: ModelClass, dialogs: Lis
             Once the streaming is over, updates the dialog history with the bot's response 
 
             """
-            dialog = __get_dialog(uu_id)
-
-            prompt_fn = dialog.replace_system_prompt if system_prompt_radio == 'Replace' else dialog.supplement_system_prompt
-
-            if system_prompt:
-                prompt_fn(system_prompt)
+            with governor.track() if governor else nullcontext(None) as generation_record: # Counting the request as in flight as soon as it arrives
+                dialog = __get_dialog(uu_id)
 
-            dialog.user_ask(chat_history[-1][0])
-            generator = llm.ask_llm_stream(dialog.get_llm_formated_dialog(), temperature=temperature, top_p=top_p, top_k=top_k, max_new_tokens=max_new_tokens)
-            chat_history[-1][1] = ""
-            for response in generator:
-                chat_history[-1][1] = response
-                yield(chat_history, dialog.UUID)
+                prompt_fn = dialog.replace_system_prompt if system_prompt_radio == 'Replace' else dialog.supplement_system_prompt
+
+                if system_prompt:
+                    prompt_fn(system_prompt)
+
+                dialog.user_ask(chat_history[-1][0])
+                generation_parameters = dict(temperature=temperature, top_p=top_p, top_k=top_k, max_new_tokens=max_new_tokens)
+                if governor:
+                    generation_parameters, warning_messages = governor.adjust(generation_parameters)
+                    for warning_message in warning_messages:
+                        gr.Warning(warning_message)
+                generator = llm.ask_llm_stream(dialog.get_llm_formated_dialog(), generation_stats=generation_record, **generation_parameters)
+                chat_history[-1][1] = ""
+                for response in generator:
+                    chat_history[-1][1] = response
+                    yield(chat_history, dialog.UUID)
             dialog.assistant_reply(str(chat_history[-1][1]))
-            dialogs.append(dialog)
+            if all(ditem is not dialog for ditem in dialogs):
+                dialogs.append(dialog)
 
 
         dict_streaming_predict = dict(fn=respond_streaming,
@@ -0,0 +1,91 @@
+from bisect import bisect, insort
+from hashlib import md5
+from typing import List
+
+
+"""
+Consistent hashing of dialog UUIDs onto a set of API server instances.
+
+Classes:
+- ConsistentHashRing: Places each instance on a hash ring at several points (virtual nodes). A key belongs to the first instance found
+                      clockwise from its hash, so adding or removing an instance only moves the keys of the ring segments it takes or leaves.
+
+"""
+
+
+def hash_key(key: str) -> int:
+    """
+    Hashes a key to a position on the ring.
+
+    Parameters:
+        key (str): The key to hash.
+
+    Returns:
+        int: A 64 bits position on the ring.
+    """
+    return int.from_bytes(md5(key.encode()).digest()[:8], 'big')
+
+
+class ConsistentHashRing:
+    """
+    Consistent hash ring mapping keys (dialog UUIDs) onto nodes (instance urls).
+
+    Attributes:
+        virtual_nodes (int): Number of points of each node on the ring, more points give a more even distribution of the keys.
+        nodes (List[str]): The nodes on the ring.
+    """
+
+    def __init__(self, nodes: List[str] = (), virtual_nodes: int = 100):
+        self.virtual_nodes = virtual_nodes
+        self.nodes = []
+        self._positions = []  # Sorted positions of the virtual nodes
+        self._owners = {}  # Position of a virtual node -> node
+        for node in nodes:
+            self.add_node(node)
+
+    def __len__(self) -> int:
+        return len(self.nodes)
+
+    def add_node(self, node: str) -> None:
+        """
+        Adds a node to the ring.
+
+        Parameters:
+            node (str): The node to add.
+        """
+        if node in self.nodes:
+            raise(ValueError(f'Node {node} is already on the ring'))
+        self.nodes.append(node)
+        for i in range(self.virtual_nodes):
+            position = hash_key(f'{node}#{i}')
+            if position not in self._owners:
+                insort(self._positions, position)
+                self._owners[position] = node
+
+    def remove_node(self, node: str) -> None:
+        """
+        Removes a node from the ring.
+
+        Parameters:
+            node (str): The node to remove.
+        """
+        if node not in self.nodes:
+            raise(ValueError(f'Node {node} is not on the ring'))
+        self.nodes.remove(node)
+        self._positions = [position for position in self._positions if self._owners[position] != node]
+        self._owners = {position: self._owners[position] for position in self._positions}
+
+    def get_node(self, key: str) -> str:
+        """
+        Returns the node owning a key.
+
+        Parameters:
+            key (str): The key, e.g. a dialog UUID.
+
+        Returns:
+            str: The node owning the key.
+        """
+        if not self._positions:
+            raise(Exception('No node on the ring'))
+        index = bisect(self._positions, hash_key(key)) % len(self._positions)
+        return self._owners[self._positions[index]]
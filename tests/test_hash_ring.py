@@ -0,0 +1,66 @@
+from collections import Counter
+from uuid import UUID
+
+import pytest
+
+from src.router.hash_ring import ConsistentHashRing
+
+
+NODES = ['http://10.0.0.1:6969', 'http://10.0.0.2:6969', 'http://10.0.0.3:6969']
+KEYS = [str(UUID(int=i)) for i in range(2000)]
+
+
+def mapping(ring):
+    return {key: ring.get_node(key) for key in KEYS}
+
+
+def test_adding_a_node_only_moves_keys_to_it():
+    ring = ConsistentHashRing(NODES)
+    before = mapping(ring)
+    ring.add_node('http://10.0.0.4:6969')
+    after = mapping(ring)
+
+    moved = [key for key in KEYS if before[key] != after[key]]
+    assert moved
+    assert all(after[key] == 'http://10.0.0.4:6969' for key in moved)
+
+
+def test_removing_a_node_only_moves_its_keys():
+    ring = ConsistentHashRing(NODES)
+    before = mapping(ring)
+    ring.remove_node('http://10.0.0.2:6969')
+    after = mapping(ring)
+
+    assert all(after[key] == before[key] for key in KEYS if before[key] != 'http://10.0.0.2:6969')
+    assert 'http://10.0.0.2:6969' not in after.values()
+
+
+def test_adding_then_removing_a_node_restores_the_mapping():
+    ring = ConsistentHashRing(NODES)
+    before = mapping(ring)
+    ring.add_node('http://10.0.0.4:6969')
+    ring.remove_node('http://10.0.0.4:6969')
+    assert mapping(ring) == before
+
+
+def test_distribution_is_deterministic():
+    # The mapping only depends on the set of nodes, not on the ring instance or the insertion order
+    assert mapping(ConsistentHashRing(NODES)) == mapping(ConsistentHashRing(NODES[::-1]))
+
+
+def test_distribution_is_balanced():
+    counts = Counter(mapping(ConsistentHashRing(NODES)).values())
+    assert set(counts) == set(NODES)
+    assert min(counts.values()) > len(KEYS) / len(NODES) / 2
+
+
+def test_errors():
+    ring = ConsistentHashRing(NODES[:1])
+    with pytest.raises(ValueError):
+        ring.add_node(NODES[0])
+    with pytest.raises(ValueError):
+        ring.remove_node(NODES[1])
+    ring.remove_node(NODES[0])
+    assert len(ring) == 0
+    with pytest.raises(Exception):
+        ring.get_node(KEYS[0])
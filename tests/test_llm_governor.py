@@ -0,0 +1,109 @@
+import time
+from threading import Event, Thread
+
+import numpy as np
+import pytest
+
+from src.backend.llm_call import LLMCall
+from src.backend.llm_governor import DegradationLevel, GenerationGovernor
+from src.backend.llm_semantic_cache import SemanticCache
+
+
+class BlockingLLM:
+    """ Stands in for ModelClass, holding every generation until released so that the requests pile up """
+    def __init__(self):
+        self.release = Event()
+        self.calls = []
+
+    def ask_llm(self, question, debug=False, generation_stats=None, **kwargs):
+        self.calls.append(kwargs)
+        self.release.wait(timeout=10)
+        generation_stats['generated_tokens'] = 10
+        generation_stats['generation_time'] = 0.1
+        return 'answer', '', {}
+
+
+def wait_for(condition, timeout=10.):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline, 'Timed out'
+        time.sleep(0.01)
+
+
+def ask(llm, dialogs, governor, results):
+    llm_call = LLMCall(question='What is the largest country in the world?', no_history=True, generation_parameters={'max_new_tokens': 128})
+    results.append(llm_call.ask_llm(llm=llm, dialogs=dialogs, governor=governor))
+
+
+def test_level_follows_concurrent_requests():
+    governor = GenerationGovernor(policy=[DegradationLevel(queue_depth=4, max_new_tokens=16, num_beams=1)])
+    llm, dialogs, results = BlockingLLM(), [], []
+    requests = [Thread(target=ask, args=(llm, dialogs, governor, results)) for _ in range(8)]
+    for request in requests:
+        request.start()
+
+    wait_for(lambda: len(llm.calls) == 8)
+    assert governor.queue_depth == 8
+    assert governor.current_level() == 0
+
+    llm.release.set()
+    for request in requests:
+        request.join()
+    assert governor.queue_depth == 0
+    assert governor.current_level() is None
+    # Each request is counted before being adjusted, so at least the last 5 requests to arrive see 4 or more requests in flight
+    capped = [call for call in llm.calls if call['max_new_tokens'] == 16 and call['num_beams'] == 1]
+    assert len(capped) >= 5
+    assert sum('max_new_tokens limited to 16' in warning_messages for _, _, warning_messages, _ in results) == len(capped)
+    assert governor.status()['adjustments'][0] == len(capped)
+    assert governor.tokens_per_second == pytest.approx(100.)
+
+    # Full settings once the load dropped
+    ask(llm, dialogs, governor, results)
+    assert llm.calls[-1] == {'max_new_tokens': 128}
+    assert results[-1][2] == ''
+
+
+def test_adjust_only_lowers_parameters():
+    governor = GenerationGovernor(policy=[DegradationLevel(queue_depth=1, max_new_tokens=64, top_k=50, max_time=10.)])
+    with governor.track():
+        parameters, warning_messages = governor.adjust({'max_new_tokens': 32, 'top_k': 100})
+    assert parameters == {'max_new_tokens': 32, 'top_k': 50, 'max_time': 10.}
+    assert len(warning_messages) == 2
+    assert governor.adjust({'max_new_tokens': 512}) == ({'max_new_tokens': 512}, [])
+
+
+def test_adjust_compares_defaults():
+    policy = [DegradationLevel(queue_depth=1, max_new_tokens=64, num_beams=1, top_k=50)]
+    governor = GenerationGovernor(policy=policy, defaults={'num_beams': 1, 'top_k': 50, 'max_new_tokens': None})
+    with governor.track():
+        # The defaults of the model are already within the caps, only max_new_tokens (no default) is capped
+        assert governor.adjust({'max_new_tokens': 32}) == ({'max_new_tokens': 32}, [])
+        assert governor.status()['adjustments'][0] == 0
+        parameters, warning_messages = governor.adjust({})
+    assert parameters == {'max_new_tokens': 64}
+    assert warning_messages == ['High server load: max_new_tokens limited to 64']
+
+    governor = GenerationGovernor(policy=policy, defaults={'num_beams': 4, 'top_k': 50, 'max_new_tokens': 32})
+    with governor.track():
+        parameters, warning_messages = governor.adjust({})
+    assert parameters == {'num_beams': 1}
+    assert warning_messages == ['High server load: num_beams limited to 1 (default 4)']
+    assert governor.status()['adjustments'][0] == 1
+
+
+def test_capped_answers_are_not_cached():
+    questions = {'What is the largest country in the world?': np.ones(4, dtype=np.float32) / 2}
+    semantic_cache = SemanticCache(lambda texts: np.stack([questions[text] for text in texts]))
+    governor = GenerationGovernor(policy=[DegradationLevel(queue_depth=1, max_new_tokens=16)])
+    llm, dialogs, results = BlockingLLM(), [], []
+    llm.release.set()
+
+    LLMCall(question='What is the largest country in the world?', no_history=True,
+            generation_parameters={'max_new_tokens': 128}).ask_llm(llm=llm, dialogs=dialogs, semantic_cache=semantic_cache, governor=governor)
+    assert llm.calls[-1] == {'max_new_tokens': 16}
+    assert len(semantic_cache) == 0
+
+    LLMCall(question='What is the largest country in the world?', no_history=True,
+            generation_parameters={'max_new_tokens': 128}).ask_llm(llm=llm, dialogs=dialogs, semantic_cache=semantic_cache)
+    assert len(semantic_cache) == 1
@@ -0,0 +1,112 @@
+import numpy as np
+
+from src.backend.llm_semantic_cache import SemanticCache
+
+
+DIM = 8
+CONTEXT = '<<SYS>> You are a helpful assistant <</SYS>>{}'
+
+
+def unit(index: int) -> np.ndarray:
+    vector = np.zeros(DIM, dtype=np.float32)
+    vector[index] = 1.
+    return vector
+
+
+def similar_to(index: int, similarity: float) -> np.ndarray:
+    """ Unit vector with the given cosine similarity to unit(index) """
+    return similarity * unit(index) + np.sqrt(1 - similarity ** 2) * unit(DIM - 1)
+
+
+# Stands in for the encoder: each question gets a fixed embedding, the similarities between them are set by hand
+EMBEDDINGS = {
+    'What is the largest country in the world?': unit(0),
+    'Which country is the largest in the world?': similar_to(0, 0.97),    # Paraphrase
+    'What is the largest country in Europe?': similar_to(0, 0.90),        # Entity swap, different answer
+    'What is the biggest country on earth?': similar_to(0, 0.94),         # Paraphrase just below the threshold
+    'What is the capital of France?': unit(1),
+    'Who wrote Hamlet?': unit(2),
+    'How tall is Mount Everest?': unit(3),
+}
+
+
+def embed_fn(texts):
+    return np.stack([EMBEDDINGS[text] for text in texts])
+
+
+def make_cache(**kwargs) -> SemanticCache:
+    cache = SemanticCache(embed_fn, **kwargs)
+    question = 'What is the largest country in the world?'
+    cache.add(cache.embed(question), CONTEXT, question, 'Russia')
+    return cache
+
+
+def lookup(cache, question, context=CONTEXT):
+    return cache.lookup(cache.embed(question), context)
+
+
+def test_paraphrase_above_threshold_hits():
+    cache = make_cache()
+    answer, diagnostics = lookup(cache, 'Which country is the largest in the world?')
+    assert answer == 'Russia'
+    assert diagnostics['hit'] and abs(diagnostics['similarity'] - 0.97) < 1e-5
+    assert diagnostics['cached_question'] == 'What is the largest country in the world?'
+
+
+def test_entity_swap_below_threshold_misses():
+    cache = make_cache()
+    answer, diagnostics = lookup(cache, 'What is the largest country in Europe?')
+    assert answer is None
+    assert not diagnostics['hit'] and abs(diagnostics['similarity'] - 0.90) < 1e-5
+
+
+def test_threshold_is_configurable():
+    cache = make_cache(similarity_threshold=0.85)
+    answer, _ = lookup(cache, 'What is the largest country in Europe?')
+    assert answer == 'Russia'
+
+
+def test_contexts_are_isolated():
+    cache = make_cache()
+    answer, diagnostics = lookup(cache, 'What is the largest country in the world?', context=CONTEXT + str({'temperature': 1.}))
+    assert answer is None
+    assert diagnostics['similarity'] is None and diagnostics['cached_question'] is None
+
+
+def test_least_recently_used_entry_is_evicted():
+    cache = make_cache(max_size=3)
+    for question, answer in [('What is the capital of France?', 'Paris'), ('Who wrote Hamlet?', 'Shakespeare')]:
+        cache.add(cache.embed(question), CONTEXT, question, answer)
+    # Using the oldest entry, the least recently used one is now the capital of France
+    assert lookup(cache, 'What is the largest country in the world?')[0] == 'Russia'
+    cache.add(cache.embed('How tall is Mount Everest?'), CONTEXT, 'How tall is Mount Everest?', '8849 m')
+
+    assert len(cache) == 3
+    assert lookup(cache, 'What is the capital of France?')[0] is None
+    assert lookup(cache, 'What is the largest country in the world?')[0] == 'Russia'
+    assert lookup(cache, 'Who wrote Hamlet?')[0] == 'Shakespeare'
+    assert lookup(cache, 'How tall is Mount Everest?')[0] == '8849 m'
+
+
+def test_counters():
+    cache = make_cache()
+    lookup(cache, 'Which country is the largest in the world?')   # Hit
+    lookup(cache, 'What is the biggest country on earth?')        # Near miss, within 0.02 of the threshold
+    lookup(cache, 'What is the largest country in Europe?')       # Miss
+    _, diagnostics = lookup(cache, 'What is the capital of France?')  # Miss
+    assert (cache.hits, cache.misses, cache.near_misses) == (1, 3, 1)
+    assert (diagnostics['hits'], diagnostics['misses'], diagnostics['near_misses'], diagnostics['size']) == (1, 3, 1, 1)
+
+
+def test_second_similarity():
+    cache = make_cache()
+    cache.add(cache.embed('What is the largest country in Europe?'), CONTEXT, 'What is the largest country in Europe?', 'Russia')
+    _, diagnostics = lookup(cache, 'What is the largest country in the world?')
+    assert abs(diagnostics['similarity'] - 1.) < 1e-5 and abs(diagnostics['second_similarity'] - 0.90) < 1e-5
+
+
+def test_clear():
+    cache = make_cache()
+    cache.clear()
+    assert len(cache) == 0
+    assert lookup(cache, 'What is the largest country in the world?')[0] is None
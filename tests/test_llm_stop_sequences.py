@@ -0,0 +1,95 @@
+import torch
+
+from src.backend.llm import ModelClass
+
+
+EOS = 1
+
+
+class CharTokenizer:
+    """ Stands in for the tokenizer, decoding each token id to a fixed piece of text """
+    VOCAB = {0: '', 1: '', 10: 'Hu', 11: 'man', 12: ':', 13: 'Hello ', 14: 'H', 15: 'uman:'}
+
+    def __init__(self):
+        self.decoded_rows = 0
+
+    def batch_decode(self, ids, skip_special_tokens=True):
+        self.decoded_rows += len(ids)
+        return [''.join(self.VOCAB.get(int(token_id), '?') for token_id in row) for row in ids]
+
+
+TOKEN_TEXTS = [CharTokenizer.VOCAB.get(token_id, '?') for token_id in range(16)]
+
+
+def test_matches_whole_batch():
+    stop_criteria = ModelClass.StopOnSequences([[5, 6], [7]], finished_token_ids=[EOS])
+    input_ids = torch.tensor([[0, 3, 5, 6],
+                              [0, 3, 4, 7],
+                              [0, 5, 4, 6],
+                              [0, 6, 5, 4]])
+    assert stop_criteria.matches(input_ids).tolist() == [True, True, False, False]
+
+
+def test_matches_sequences_shorter_than_stop_sequences():
+    stop_criteria = ModelClass.StopOnSequences([[5, 6, 8], [7]], finished_token_ids=[EOS])
+    assert stop_criteria.matches(torch.tensor([[0, 7], [0, 6]])).tolist() == [True, False]
+
+
+def test_rows_stop_at_different_steps():
+    stop_criteria = ModelClass.StopOnSequences([[5, 6]], finished_token_ids=[EOS])
+    finish = ModelClass.FinishOnStopSequences(stop_criteria, eos_token_id=EOS)
+
+    # Step 1: the first row reaches the stop sequence, the second one keeps generating
+    input_ids = torch.tensor([[0, 5, 6], [0, 3, 4]])
+    assert not stop_criteria(input_ids, None)
+    scores = finish(input_ids, torch.zeros(2, 10))
+    assert scores[0].argmax() == EOS and torch.isinf(scores[0]).sum() == 9
+    assert not torch.isinf(scores[1]).any()
+
+    # Step 2: the first row is finished, the second one reaches the stop sequence
+    input_ids = torch.tensor([[0, 5, 6, EOS], [0, 3, 5, 6]])
+    assert stop_criteria(input_ids, None)
+
+
+def test_text_fallback_when_tokenized_differently():
+    # 'Human:' tokenized on its own ([14, 15]) differs from the tokens generated in context ([10, 11, 12])
+    stop_criteria = ModelClass.StopOnSequences([[14, 15]], finished_token_ids=[EOS], stop_sequences=['Human:'], tokenizer=CharTokenizer())
+    input_ids = torch.tensor([[0, 13, 10, 11, 12],
+                              [0, 13, 13, 13, 13],
+                              [0, 13, 13, 14, 15]])
+    assert stop_criteria.matches(input_ids).tolist() == [True, False, True]
+
+
+def test_text_fallback_only_for_tokens_ending_stop_sequences():
+    tokenizer = CharTokenizer()
+    stop_end_ids = ModelClass.get_stop_end_ids(['Human:'], TOKEN_TEXTS)
+    assert stop_end_ids == [12, 15]
+    stop_criteria = ModelClass.StopOnSequences([[14, 15]], finished_token_ids=[EOS], stop_sequences=['Human:'], tokenizer=tokenizer,
+                                               stop_end_ids=stop_end_ids)
+    input_ids = torch.tensor([[0, 13, 10, 11, 12],
+                              [0, 13, 13, 13, 13],
+                              [0, 13, 13, 14, 15]])
+    assert stop_criteria.matches(input_ids).tolist() == [True, False, True]
+    # The last row is matched on the token ids and the second row cannot end with 'Human:', only the first row is decoded
+    assert tokenizer.decoded_rows == 1
+
+    stop_criteria.matches(torch.tensor([[0, 13, 10, 11], [0, 13, 13, 13]]))
+    assert tokenizer.decoded_rows == 1
+
+
+def test_stop_end_ids_with_trailing_whitespace():
+    assert ModelClass.get_stop_end_ids(['Human: '], TOKEN_TEXTS) is None
+    assert ModelClass.get_stop_end_ids(['###', 'H'], TOKEN_TEXTS) == [10, 13, 14]
+
+
+def test_trim_stop_sequences():
+    assert ModelClass.trim_stop_sequences('Hello Human: hi ### bye', ['###', 'Human:']) == 'Hello '
+    assert ModelClass.trim_stop_sequences('Hello', ['Human:']) == 'Hello'
+    assert ModelClass.trim_stop_sequences('Hello', []) == 'Hello'
+
+
+def test_stop_sequence_prefix_len():
+    assert ModelClass.stop_sequence_prefix_len('Hello Hum', ['Human:']) == 3
+    assert ModelClass.stop_sequence_prefix_len('Hello #', ['Human:', '###']) == 1
+    assert ModelClass.stop_sequence_prefix_len('Hello', ['Human:']) == 0
+    assert ModelClass.stop_sequence_prefix_len('Hello', []) == 0